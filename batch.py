@@ -0,0 +1,281 @@
+"""
+JSONLファイルの質問をまとめて Gemini API に問い合わせるバッチ実行モジュール
+
+使い方:
+    python batch.py input.jsonl output.jsonl [--concurrency 4] [--temperature 0.7]
+
+入力ファイルは1行1質問のJSONLで、以下のキーを持つ:
+- id: 質問のID（省略時は行番号）
+- q: 質問文字列
+- models: モデル名のリスト（省略可能）
+- roles: 役割のリスト（省略可能）
+- max_tokens: 最大トークン数（省略可能）
+
+出力ファイルには1行1回答（モデルと役割の組み合わせごと）を終わった順に追記する。
+同じ出力ファイルを指定して再実行すると、回答済みの組み合わせは問い合わせない。
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import sys
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+from typing import Any
+
+from pydantic import ValidationError
+
+import searchapi
+from models import MultiOptions
+from searchapi import aquery_gemini, grid_cells
+
+logger = logging.getLogger(__name__)
+
+# 同時に実行する問い合わせ件数のデフォルト値
+DEFAULT_CONCURRENCY = 4
+
+
+class CompletedIndex:
+    """回答済みの組み合わせと読み込んだ質問IDを管理するクラス
+
+    SQLite の一時データベース（ディスク上）に保持するので、
+    メモリ使用量は出力ファイルや入力ファイルの大きさによらない
+    """
+
+    def __init__(self) -> None:
+        self._conn = sqlite3.connect("")
+        self._conn.executescript(
+            """
+            CREATE TABLE completed (
+                id TEXT NOT NULL, cell INTEGER NOT NULL, PRIMARY KEY (id, cell)
+            ) WITHOUT ROWID;
+            CREATE TABLE seen (id TEXT PRIMARY KEY) WITHOUT ROWID;
+            """
+        )
+
+    def add_completed(self, records: Iterable[tuple[str, int]]) -> None:
+        """回答済みの (質問ID, 組み合わせ番号) を追加する"""
+        self._conn.executemany("INSERT OR IGNORE INTO completed VALUES (?, ?)", records)
+
+    def completed_cells(self, qid: str) -> set[int]:
+        """質問IDの回答済みの組み合わせ番号を返す"""
+        rows = self._conn.execute("SELECT cell FROM completed WHERE id = ?", (qid,))
+        return {cell for (cell,) in rows}
+
+    def mark_seen(self, qid: str) -> bool:
+        """質問IDを読み込み済みにする（すでに読み込み済みの場合は False）"""
+        cursor = self._conn.execute("INSERT OR IGNORE INTO seen VALUES (?)", (qid,))
+        return cursor.rowcount == 1
+
+    def close(self) -> None:
+        """一時データベースを閉じて削除する"""
+        self._conn.close()
+
+
+def load_completed(output_path: Path) -> CompletedIndex:
+    """出力ファイルから回答済みの (質問ID, 組み合わせ番号) を読み込む関数
+
+    エラーになった行、クラッシュ時の書きかけの行、id と cell を持たない行は
+    回答済みとみなさない
+
+    Args:
+        output_path: 出力ファイルのパス
+
+    Returns:
+        CompletedIndex: 回答済みの組み合わせを保持するインデックス
+    """
+    index = CompletedIndex()
+    if not output_path.exists():
+        return index
+
+    def iter_completed() -> Iterator[tuple[str, int]]:
+        with output_path.open(encoding="utf-8", errors="replace") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if (
+                    isinstance(record, dict)
+                    and "result" in record
+                    and "id" in record
+                    and "cell" in record
+                ):
+                    yield record["id"], record["cell"]
+
+    index.add_completed(iter_completed())
+    return index
+
+
+def iter_jobs(
+    input_path: Path,
+    completed: CompletedIndex,
+    temperature: float,
+) -> Iterator[dict[str, Any]]:
+    """入力ファイルを1行ずつ読み、未回答の組み合わせを順に生成する関数
+
+    不正な行や、前の行と質問IDが重複する行は警告を出して読み飛ばす
+
+    Args:
+        input_path: 入力ファイルのパス
+        completed: 回答済みの組み合わせを保持するインデックス
+        temperature: ランダムさ
+
+    Returns:
+        Iterator[dict[str, Any]]: id, cell, 問い合わせ引数 (kwargs) を持つ辞書
+    """
+    with input_path.open(encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise TypeError("JSONオブジェクトではありません")
+                qid = str(record.get("id", lineno))
+                q = record["q"]
+                options = MultiOptions(
+                    **{
+                        key: record[key]
+                        for key in ("models", "roles", "max_tokens")
+                        if key in record
+                    }
+                )
+            except (json.JSONDecodeError, KeyError, TypeError, ValidationError) as e:
+                logger.warning("%s 行目を読み飛ばします: %s", lineno, e)
+                continue
+            if not completed.mark_seen(qid):
+                logger.warning(
+                    "%s 行目を読み飛ばします: ID %s が重複しています", lineno, qid
+                )
+                continue
+
+            completed_cells = completed.completed_cells(qid)
+            cells = grid_cells(options.roles, options.models)
+            for cell, (model_name, role) in enumerate(cells, 1):
+                if cell in completed_cells:
+                    continue
+                yield {
+                    "id": qid,
+                    "cell": cell,
+                    "kwargs": {
+                        "q": q,
+                        "role": role,
+                        "model_name": model_name,
+                        "temperature": temperature,
+                        "max_tokens": options.max_tokens,
+                    },
+                }
+
+
+async def run_batch(
+    input_path: Path,
+    output_path: Path,
+    concurrency: int = DEFAULT_CONCURRENCY,
+    temperature: float = 0.7,
+) -> int:
+    """入力ファイルの質問をすべて問い合わせ、結果を出力ファイルに追記する関数
+
+    入力は1行ずつ読み、待ち行列の長さを concurrency 件に抑え、
+    回答済みの組み合わせはディスク上のインデックスで管理するので、
+    メモリ使用量は入力ファイルや出力ファイルの大きさによらない
+
+    Args:
+        input_path: 入力ファイルのパス
+        output_path: 出力ファイルのパス
+        concurrency: 同時に実行する問い合わせ件数
+        temperature: ランダムさ
+
+    Returns:
+        int: 今回書き込んだ回答の件数
+    """
+    completed = load_completed(output_path)
+    jobs = iter_jobs(input_path, completed, temperature)
+    queue: asyncio.Queue[dict[str, Any] | None] = asyncio.Queue(maxsize=concurrency)
+    written = 0
+
+    # 書きかけの行が残っている場合は改行してから追記する
+    needs_newline = False
+    if output_path.exists() and output_path.stat().st_size > 0:
+        with output_path.open("rb") as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b"\n"
+
+    with output_path.open("a", encoding="utf-8") as out:
+        if needs_newline:
+            out.write("\n")
+
+        async def worker() -> None:
+            nonlocal written
+            while (job := await queue.get()) is not None:
+                try:
+                    result, args = await aquery_gemini(**job["kwargs"])
+                except Exception as e:
+                    # 1件の失敗でバッチ全体を止めない（再実行時に再度問い合わせる）
+                    record = {"id": job["id"], "cell": job["cell"], "error": str(e)}
+                else:
+                    record = {
+                        "id": job["id"],
+                        "cell": job["cell"],
+                        "result": result,
+                        "args": args,
+                    }
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                written += 1
+
+        # 書き込みの失敗などでワーカーが止まった場合は、TaskGroup が
+        # 投入側（queue.put で待っている）も取り消して例外を送出する
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for _ in range(concurrency):
+                    tg.create_task(worker())
+                for job in jobs:
+                    await queue.put(job)
+                for _ in range(concurrency):
+                    await queue.put(None)
+        finally:
+            completed.close()
+
+    return written
+
+
+def main(argv: list[str] | None = None) -> int:
+    """コマンドラインのエントリーポイント"""
+    parser = argparse.ArgumentParser(
+        description="JSONLファイルの質問をまとめて Gemini API に問い合わせる"
+    )
+    parser.add_argument("input", type=Path, help="入力JSONLファイル")
+    parser.add_argument("output", type=Path, help="出力JSONLファイル（追記）")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"同時に実行する問い合わせ件数（デフォルト: {DEFAULT_CONCURRENCY}）",
+    )
+    parser.add_argument(
+        "--temperature",
+        type=float,
+        default=0.7,
+        help="ランダムさ（デフォルト: 0.7）",
+    )
+    args = parser.parse_args(argv)
+
+    if args.concurrency < 1:
+        parser.error("--concurrency は1以上を指定してください")
+    if not searchapi.HAS_API_KEY:
+        logger.error("GOOGLE_API_KEY 環境変数が設定されていません。")
+        return 1
+
+    written = asyncio.run(
+        run_batch(args.input, args.output, args.concurrency, args.temperature)
+    )
+    logger.info("%s 件の回答を %s に書き込みました", written, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
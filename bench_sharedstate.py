@@ -0,0 +1,104 @@
+"""
+sharedstate モジュールのオーバーヘッドを計測するベンチマーク
+
+使い方:
+    python bench_sharedstate.py [--iterations 2000] [--processes 4]
+
+1リクエストあたりの調整コスト（問い合わせ自体を除いた時間）を計測する:
+- direct: SharedState を使わない場合（比較用）
+- cache hit: キャッシュにある場合
+- cache miss: キャッシュにない場合（実行権の取得、保存、解放）
+- cache miss + rate limit: さらにレート制限のトークンを取得する場合
+- N processes: N プロセスから同時にキャッシュにない問い合わせを行う場合
+"""
+
+import argparse
+import multiprocessing
+import statistics
+import tempfile
+import time
+import uuid
+from collections.abc import Callable
+from pathlib import Path
+
+from sharedstate import SharedState
+
+
+def compute() -> str:
+    """問い合わせの代わりにすぐ値を返す関数"""
+    return "回答"
+
+
+def measure(func: Callable[[int], object], iterations: int) -> list[float]:
+    """func を iterations 回実行し、1回ごとの時間（秒）を返す"""
+    durations = []
+    for i in range(iterations):
+        started_at = time.perf_counter()
+        func(i)
+        durations.append(time.perf_counter() - started_at)
+    return durations
+
+
+def report(name: str, durations: list[float]) -> None:
+    """計測結果を1行で表示する"""
+    durations = sorted(durations)
+    p50 = statistics.median(durations)
+    p99 = durations[int(len(durations) * 0.99) - 1]
+    print(f"{name:<28} p50 {p50 * 1e6:9.1f} us   p99 {p99 * 1e6:9.1f} us")
+
+
+def worker(path: str, iterations: int) -> list[float]:
+    """別プロセスでキャッシュにない問い合わせを行う"""
+    state = SharedState(path, rate_per_minute=1e9)
+    prefix = uuid.uuid4().hex
+    return measure(
+        lambda i: state.get_or_compute(f"{prefix}-{i}", compute, "model"), iterations
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--processes", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = str(Path(tmpdir) / "state.db")
+        state = SharedState(path)
+        limited = SharedState(path, rate_per_minute=1e9)
+
+        report("direct", measure(lambda i: compute(), args.iterations))
+
+        state.get_or_compute("hit", compute, "model")
+        report(
+            "cache hit",
+            measure(
+                lambda i: state.get_or_compute("hit", compute, "model"),
+                args.iterations,
+            ),
+        )
+        report(
+            "cache miss",
+            measure(
+                lambda i: state.get_or_compute(f"miss-{i}", compute, "model"),
+                args.iterations,
+            ),
+        )
+        report(
+            "cache miss + rate limit",
+            measure(
+                lambda i: limited.get_or_compute(f"limited-{i}", compute, "model"),
+                args.iterations,
+            ),
+        )
+
+        with multiprocessing.Pool(args.processes) as pool:
+            results = pool.starmap(worker, [(path, args.iterations)] * args.processes)
+        report(
+            f"{args.processes} processes (miss + limit)",
+            [d for durations in results for d in durations],
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+リクエストの形と処理時間を記録するモジュール
+
+記録したファイルは replay.py で再生できる。
+記録には認証キーを含めず、指定した場合は質問文字列をハッシュ値と文字数に置き換える。
+"""
+
+import hashlib
+import json
+import queue
+import threading
+from typing import Any
+
+# 記録するエンドポイント
+CAPTURE_PATHS = ("/single", "/multi", "/multi-async")
+
+# 記録時に認証エラー（401）だったリクエストの再生に使う認証キー
+INVALID_KEY = "replay-invalid-key"
+
+
+def shape_body(body: bytes, hash_questions: bool) -> dict[str, Any] | None:
+    """リクエストボディから記録用の辞書を作る関数
+
+    Args:
+        body: リクエストボディ
+        hash_questions: 質問文字列をハッシュ値と文字数に置き換えるか
+
+    Returns:
+        dict[str, Any] | None: 記録用の辞書（JSONでない場合は None）
+    """
+    try:
+        data = json.loads(body)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    data.pop("key", None)
+    q = data.get("q")
+    if hash_questions and isinstance(q, str):
+        data["q"] = "sha256:" + hashlib.sha256(q.encode()).hexdigest()[:16]
+        data["q_len"] = len(q)
+    return data
+
+
+def restore_body(
+    shape: dict[str, Any], key: str, status: int | None = None
+) -> dict[str, Any]:
+    """記録用の辞書から再生用のリクエストボディを作る関数
+
+    ハッシュ値に置き換えた質問文字列は、同じ文字数のダミー文字列にする
+    記録時に認証エラー（401）だった場合は、再生時も認証エラーになるように
+    無効な認証キーを使う
+
+    Args:
+        shape: shape_body 関数の戻り値
+        key: 認証キー
+        status: 記録時のステータスコード
+
+    Returns:
+        dict[str, Any]: リクエストボディ
+    """
+    data = dict(shape)
+    q_len = data.pop("q_len", None)
+    if q_len is not None:
+        data["q"] = "あ" * q_len
+    data["key"] = INVALID_KEY if status == 401 else key
+    return data
+
+
+class TrafficRecorder:
+    """リクエストを JSONL ファイルに1行ずつ追記するクラス
+
+    イベントループを止めないように、ファイルへの書き込みは専用のスレッドで行う
+    """
+
+    def __init__(self, path: str, hash_questions: bool = False) -> None:
+        """
+        Args:
+            path: 記録するファイルのパス
+            hash_questions: 質問文字列をハッシュ値と文字数に置き換えるか
+        """
+        self.hash_questions = hash_questions
+        self._file = open(path, "a", encoding="utf-8")
+        self._queue: queue.Queue[dict[str, Any] | None] = queue.Queue()
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def record(
+        self,
+        started_at: float,
+        path: str,
+        query: str,
+        body: bytes,
+        status: int,
+        duration: float,
+    ) -> None:
+        """1件のリクエストを書き込み待ちに追加する（close 後は何もしない）
+
+        Args:
+            started_at: 受信時刻（エポック秒）
+            path: パス
+            query: クエリ文字列
+            body: リクエストボディ
+            status: ステータスコード
+            duration: 処理時間（秒）
+        """
+        if self._closed:
+            return
+        self._queue.put(
+            {
+                "t": started_at,
+                "path": path,
+                "query": query,
+                "status": status,
+                "duration": duration,
+                "body": body,
+            }
+        )
+
+    def flush(self) -> None:
+        """書き込み待ちの記録がすべてファイルに書き込まれるまで待つ"""
+        self._queue.join()
+
+    def close(self) -> None:
+        """書き込み待ちの記録を書き込んでからファイルを閉じる"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._writer.join()
+        self._file.close()
+
+    def _write_loop(self) -> None:
+        """書き込み待ちの記録をファイルに書き込む（書き込みスレッドで実行する）"""
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                item["body"] = shape_body(item["body"], self.hash_questions)
+                self._file.write(
+                    json.dumps(item, ensure_ascii=False, separators=(",", ":")) + "\n"
+                )
+                # 続けて記録が来ている場合はまとめて書き込む
+                if self._queue.empty():
+                    self._file.flush()
+            finally:
+                self._queue.task_done()
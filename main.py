@@ -1,31 +1,245 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import itertools
+import json
+import math
+import os
 import time
+from contextlib import AbstractContextManager, asynccontextmanager, nullcontext
+
+from fastapi import (
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Request,
+    Response,
+    WebSocket,
+    status,
+)
+from pydantic import ValidationError
 
-from fastapi import FastAPI, HTTPException
-
+from capture import CAPTURE_PATHS, TrafficRecorder
 from models import (
     ApiResponse,
     MultiQueryItem,
     MultiQueryResponse,
     MultiRequest,
+    Options,
     QueryResponse,
     SingleRequest,
+    UsageSummary,
+    WsMessage,
+    WsMultiMessage,
+    WsSingleMessage,
 )
+from profiling import PhaseTimer, ProcessProfile, load_profile
 from searchapi import (
     AVAILABLE_MODELS,
+    GRID_CHUNK_SIZE,
+    SHARED_STATE,
     agrid_query_gemini,
+    aquery_gemini,
+    grid_cells,
     grid_query_gemini,
     query_gemini,
 )
+from sharedstate import RateLimitError
+from usage import UsageLedger, caller_id, total_usage
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """アプリの終了時にトラフィックの記録ファイルを閉じる"""
+    yield
+    if CAPTURE is not None:
+        CAPTURE.close()
+
 
 app = FastAPI(
     title="PyCon JP 2025 Camp Tutorial API",
     description="PyCon JP 2025 Camp Tutorialの API サーバー",
     version="0.1.0",
+    lifespan=lifespan,
 )
 
 # 仮の認証キー（実際の運用では環境変数などから取得すべき）
 AUTH_KEY = "pyconjp2025"
 
+# WebSocketの1接続で同時に処理する問い合わせの最大件数
+WS_MAX_IN_FLIGHT = 8
+# WebSocketの送信待ちメッセージの最大件数（超えると問い合わせ側が待つ）
+WS_SEND_QUEUE_SIZE = 32
+
+# 仮の管理者キー（プロファイルの取得とダウンロードに使用する）
+ADMIN_KEY = "pyconjp2025-admin"
+
+# 呼び出し元・モデルごとのトークン使用量
+# （SHARED_STATE_PATH を指定した場合はワーカー間で共有する）
+USAGE = UsageLedger(SHARED_STATE)
+
+
+# トラフィックの記録（CAPTURE_PATH 指定時のみ、replay.py で再生できる）
+CAPTURE: TrafficRecorder | None = None
+if os.getenv("CAPTURE_PATH"):
+    CAPTURE = TrafficRecorder(
+        os.environ["CAPTURE_PATH"],
+        hash_questions=os.getenv("CAPTURE_HASH_QUESTIONS") == "1",
+    )
+
+
+@app.middleware("http")
+async def capture_traffic(request: Request, call_next):
+    """CAPTURE が設定されている場合にリクエストの形と処理時間を記録する"""
+    if CAPTURE is None or request.url.path not in CAPTURE_PATHS:
+        return await call_next(request)
+
+    started_at = time.time()
+    body = await request.body()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        CAPTURE.record(
+            started_at=started_at,
+            path=request.url.path,
+            query=request.url.query,
+            body=body,
+            status=status_code,
+            duration=time.time() - started_at,
+        )
+    return response
+
+
+@app.middleware("http")
+async def record_received_at(request: Request, call_next):
+    """リクエストの受信時刻を記録する（処理時間の内訳の計測用）
+
+    エンドポイントが handler_done_at を記録した場合（timing を指定した場合）は、
+    それ以降の応答の検証と JSON への変換にかかった時間を
+    Server-Timing ヘッダーの serialize として返す
+    """
+    request.state.received_at = time.perf_counter()
+    response = await call_next(request)
+    handler_done_at = getattr(request.state, "handler_done_at", None)
+    if handler_done_at is not None:
+        now = time.perf_counter()
+        serialize_ms = (now - handler_done_at) * 1000
+        total_ms = (now - request.state.received_at) * 1000
+        response.headers["Server-Timing"] = (
+            f"serialize;dur={serialize_ms:.3f}, total;dur={total_ms:.3f}"
+        )
+    return response
+
+
+async def validated_single(data: SingleRequest, request: Request) -> SingleRequest:
+    """single のリクエストボディの検証が終わった時刻を記録する
+
+    イベントループで実行するので、同期のエンドポイントでは、この時刻から
+    エンドポイントの開始までの時間がスレッドプールの空き待ち（queue）になる
+    """
+    request.state.validated_at = time.perf_counter()
+    return data
+
+
+async def validated_multi(data: MultiRequest, request: Request) -> MultiRequest:
+    """multi のリクエストボディの検証が終わった時刻を記録する"""
+    request.state.validated_at = time.perf_counter()
+    return data
+
+
+def start_profile(
+    profile: bool, admin_key: str | None
+) -> AbstractContextManager[str | None]:
+    """プロファイルを取得するコンテキストマネージャを返す
+
+    プロファイルは with 文の間のプロセス全体（同時に処理している他のリクエストを含む）
+    を記録したもの。profile が False の場合は何もしないコンテキストマネージャを返す
+    with 文の値はプロファイルのID（取得しない場合は None）
+    """
+    if not profile:
+        return nullcontext()
+    if admin_key != ADMIN_KEY:
+        raise HTTPException(status_code=403, detail="管理者キーが無効です")
+    try:
+        return ProcessProfile(SHARED_STATE)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e)) from e
+
+
+def rate_limit_exception(e: RateLimitError) -> HTTPException:
+    """レート制限の例外を 429 (Retry-After ヘッダー付き) の HTTPException にする"""
+    return HTTPException(
+        status_code=429,
+        detail=str(e),
+        headers={"Retry-After": str(math.ceil(e.retry_after))},
+    )
+
+
+def grid_hash(data: MultiRequest) -> str:
+    """カーソルを発行したグリッド（モデル・役割・ページサイズ）のハッシュ値"""
+    payload = json.dumps(
+        [data.options.models, data.options.roles, data.options.page_size],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+
+def encode_cursor(offset: int, data: MultiRequest) -> str:
+    """次のページの開始位置とグリッドのハッシュ値をカーソル文字列に変換する"""
+    cursor = f"{offset}:{grid_hash(data)}"
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def decode_cursor(cursor: str, data: MultiRequest) -> int:
+    """カーソル文字列を開始位置に変換する
+
+    不正なカーソルや、別のグリッドのリクエストで発行されたカーソルの場合は
+    ValueError を送出する
+    """
+    try:
+        offset_str, cursor_hash = (
+            base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        )
+        offset = int(offset_str)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError("カーソルが無効です") from e
+    if offset < 0 or cursor_hash != grid_hash(data):
+        raise ValueError("カーソルが無効です")
+    return offset
+
+
+def page_range(data: MultiRequest) -> tuple[int, int, int]:
+    """複数問い合わせで今回実行する組み合わせの範囲を求める
+
+    戻り値:
+    - (開始位置, 終了位置, 組み合わせの総数)
+    """
+    total = len(data.options.models) * len(data.options.roles)
+    if data.cursor is None:
+        start = 0
+    else:
+        try:
+            start = decode_cursor(data.cursor, data)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e)) from e
+        if start >= total:
+            raise HTTPException(status_code=400, detail="カーソルが無効です")
+    page_size = data.options.page_size
+    stop = total if page_size is None else min(start + page_size, total)
+    return start, stop, total
+
+
+def page_meta(data: MultiRequest, stop: int, total: int) -> dict[str, int | str | None]:
+    """ページングの情報を meta 用の辞書にする"""
+    return {
+        "total": total,
+        "next_cursor": encode_cursor(stop, data) if stop < total else None,
+    }
+
 
 @app.get("/")
 def index(name: str = "匿名"):
@@ -42,7 +256,13 @@ def index(name: str = "匿名"):
 
 
 @app.post("/single", response_model=ApiResponse)
-def single(data: SingleRequest):
+def single(
+    request: Request,
+    data: SingleRequest = Depends(validated_single),
+    timing: bool = False,
+    profile: bool = False,
+    x_admin_key: str | None = Header(None),
+):
     """
     単一の問い合わせを行うエンドポイント
 
@@ -53,6 +273,9 @@ def single(data: SingleRequest):
       - options: オプション設定（省略可能）
         - model: モデル名（デフォルト: gemini-2.0-flash）
         - max_tokens: 最大トークン数（デフォルト: 1024）
+    - timing: 処理時間の内訳を meta に含めるか（省略可能）
+    - profile: 処理中のプロセス全体の cProfile を取得するか
+      （省略可能、X-Admin-Key ヘッダーが必要、同時に処理中の他のリクエストも含む）
 
     戻り値:
     - ApiResponse: API応答の基本形式
@@ -61,10 +284,20 @@ def single(data: SingleRequest):
         - args: QueryArgs型の辞書
       - meta:
         - duration: 処理時間（秒）
+        - usage: トークン使用量と概算費用の合計
+        - timing: 処理時間の内訳（秒、timing を指定した場合）
+          （queue はスレッドプールの空き待ち、
+          応答の変換時間は Server-Timing ヘッダーの serialize で返す）
+        - profile_id: プロファイルのID（profile を指定した場合）
     """
+    timer = PhaseTimer(getattr(request.state, "received_at", None))
+    timer.lap("validation", at=request.state.validated_at)
+    timer.lap("queue")
+
     # 認証キーの確認
     if data.key != AUTH_KEY:
         raise HTTPException(status_code=401, detail="認証キーが無効です")
+    timer.lap("auth")
 
     start_time = time.time()
 
@@ -75,19 +308,27 @@ def single(data: SingleRequest):
     else:
         model_name = options.model
         max_tokens = options.max_tokens
+    cell_timings: dict[str, float] | None = {} if timing else None
+    profile_context = start_profile(profile, x_admin_key)
     try:
-        # Gemini APIに問い合わせ
-        result, args = query_gemini(
-            q=data.q,
-            role="あなたは親切なアシスタントです。",
-            model_name=model_name, 
-            temperature=0.7,
-            max_tokens=max_tokens,
-        )
+        with profile_context as profile_id:
+            # Gemini APIに問い合わせ
+            result, args = query_gemini(
+                q=data.q,
+                role="あなたは親切なアシスタントです。",
+                model_name=model_name,
+                temperature=0.7,
+                max_tokens=max_tokens,
+                timings=cell_timings,
+            )
+    except RateLimitError as e:
+        raise rate_limit_exception(e) from e
     except ValueError as e:
         # Gemini APIの環境変数が設定されていない場合など
         raise HTTPException(status_code=500, detail=str(e))
     else:
+        timer.lap("query")
+        USAGE.record(caller_id(data.key), [args])
         end_time = time.time()
         duration = end_time - start_time
 
@@ -97,14 +338,26 @@ def single(data: SingleRequest):
                 result=result,
                 args=args,
             ),
-            meta={"duration": duration},
+            meta={"duration": duration, "usage": total_usage([args])},
         )
+        timer.lap("response")
+        if cell_timings is not None:
+            response.meta["timing"] = {**timer.phases, **cell_timings}
+            request.state.handler_done_at = time.perf_counter()
+        if profile_id is not None:
+            response.meta["profile_id"] = profile_id
 
         return response
 
 
 @app.post("/multi", response_model=MultiQueryResponse)
-def multi(data: MultiRequest):
+def multi(
+    request: Request,
+    data: MultiRequest = Depends(validated_multi),
+    timing: bool = False,
+    profile: bool = False,
+    x_admin_key: str | None = Header(None),
+):
     """
     複数の問い合わせを行うエンドポイント
 
@@ -112,10 +365,15 @@ def multi(data: MultiRequest):
     - request: MultiRequestモデルのリクエスト
       - key: 認証キー
       - q: 質問文字列
+      - cursor: 続きのページを取得するカーソル（省略可能）
       - options: オプション設定
         - models: モデル名のリスト（デフォルト: [gemini-2.0-flash]）
         - roles: 役割のリスト（デフォルト: ["あなたは親切なアシスタントです。"]）
         - max_tokens: 最大トークン数（デフォルト: 1024）
+        - page_size: 1回で返す回答の最大件数（省略時はすべて）
+    - timing: 処理時間の内訳を meta に含めるか（省略可能）
+    - profile: 処理中のプロセス全体の cProfile を取得するか
+      （省略可能、X-Admin-Key ヘッダーが必要、同時に処理中の他のリクエストも含む）
 
     戻り値:
     - MultiQueryResponse: 複数の応答を含むAPI応答
@@ -125,33 +383,58 @@ def multi(data: MultiRequest):
         - args: QueryArgs型の辞書
       - meta:
         - duration: 処理時間（秒）
+        - usage: トークン使用量と概算費用の合計
+        - total: 組み合わせの総数
+        - next_cursor: 次のページのカーソル（最後のページの場合は None）
+        - timing: 処理時間の内訳（秒、timing を指定した場合）
+          （queue はスレッドプールの空き待ち、
+          応答の変換時間は Server-Timing ヘッダーの serialize で返す）
+          - cells: 組み合わせごとの処理時間
+        - profile_id: プロファイルのID（profile を指定した場合）
     """
+    timer = PhaseTimer(getattr(request.state, "received_at", None))
+    timer.lap("validation", at=request.state.validated_at)
+    timer.lap("queue")
+
     # 認証キーの確認
     if data.key != AUTH_KEY:
         raise HTTPException(status_code=401, detail="認証キーが無効です")
+    timer.lap("auth")
 
     start_time = time.time()
 
+    start, stop, total = page_range(data)
     model_names = tuple(data.options.models)
     roles = tuple(data.options.roles)
     max_tokens = data.options.max_tokens
+    cell_timings: list[dict[str, float]] | None = [] if timing else None
+    profile_context = start_profile(profile, x_admin_key)
 
     try:
-        # grid_query_geminiを呼び出して、複数の組み合わせで問い合わせる
-        results = grid_query_gemini(
-            q=data.q,
-            roles=roles,
-            model_names=model_names,
-            temperature=0.7,
-            max_tokens=max_tokens,
-        )
+        with profile_context as profile_id:
+            # grid_query_geminiを呼び出して、複数の組み合わせで問い合わせる
+            results = grid_query_gemini(
+                q=data.q,
+                roles=roles,
+                model_names=model_names,
+                temperature=0.7,
+                max_tokens=max_tokens,
+                start=start,
+                stop=stop,
+                timings=cell_timings,
+            )
+    except RateLimitError as e:
+        raise rate_limit_exception(e) from e
     except ValueError as e:
         # Gemini APIの環境変数が設定されていない場合など
         raise HTTPException(status_code=500, detail=str(e))
     else:
+        timer.lap("query")
+        args_list = [args for _, args in results]
+        USAGE.record(caller_id(data.key), args_list)
         # 回答をMultiQueryItemに変換
         multi_query_items = []
-        for idx, (result, args) in enumerate(results, 1):
+        for idx, (result, args) in enumerate(results, start + 1):
             multi_query_items.append(
                 MultiQueryItem(
                     id=idx,
@@ -165,13 +448,29 @@ def multi(data: MultiRequest):
         # 応答を作成
         response = MultiQueryResponse(
             data=multi_query_items,
-            meta={"duration": duration},
+            meta={
+                "duration": duration,
+                "usage": total_usage(args_list),
+                **page_meta(data, stop, total),
+            },
         )
+        timer.lap("response")
+        if cell_timings is not None:
+            response.meta["timing"] = {**timer.phases, "cells": cell_timings}
+            request.state.handler_done_at = time.perf_counter()
+        if profile_id is not None:
+            response.meta["profile_id"] = profile_id
         return response
 
 
 @app.post("/multi-async", response_model=MultiQueryResponse)
-async def multi_async(data: MultiRequest):
+async def multi_async(
+    data: MultiRequest,
+    request: Request,
+    timing: bool = False,
+    profile: bool = False,
+    x_admin_key: str | None = Header(None),
+):
     """
     複数の問い合わせを非同期で行うエンドポイント
 
@@ -179,10 +478,15 @@ async def multi_async(data: MultiRequest):
     - request: MultiRequestモデルのリクエスト
       - key: 認証キー
       - q: 質問文字列
+      - cursor: 続きのページを取得するカーソル（省略可能）
       - options: オプション設定
         - models: モデル名のリスト（デフォルト: [gemini-2.0-flash]）
         - roles: 役割のリスト（デフォルト: ["あなたは親切なアシスタントです。"]）
         - max_tokens: 最大トークン数（デフォルト: 1024）
+        - page_size: 1回で返す回答の最大件数（省略時はすべて）
+    - timing: 処理時間の内訳を meta に含めるか（省略可能）
+    - profile: 処理中のプロセス全体の cProfile を取得するか
+      （省略可能、X-Admin-Key ヘッダーが必要、同時に処理中の他のリクエストも含む）
 
     戻り値:
     - MultiQueryResponse: 複数の応答を含むAPI応答
@@ -192,33 +496,56 @@ async def multi_async(data: MultiRequest):
         - args: QueryArgs型の辞書
       - meta:
         - duration: 処理時間（秒）
+        - usage: トークン使用量と概算費用の合計
+        - total: 組み合わせの総数
+        - next_cursor: 次のページのカーソル（最後のページの場合は None）
+        - timing: 処理時間の内訳（秒、timing を指定した場合）
+          （応答の変換時間は Server-Timing ヘッダーの serialize で返す）
+          - cells: 組み合わせごとの処理時間
+        - profile_id: プロファイルのID（profile を指定した場合）
     """
+    timer = PhaseTimer(getattr(request.state, "received_at", None))
+    timer.lap("validation")
+
     # 認証キーの確認
     if data.key != AUTH_KEY:
         raise HTTPException(status_code=401, detail="認証キーが無効です")
+    timer.lap("auth")
 
     start_time = time.time()
 
+    start, stop, total = page_range(data)
     model_names = tuple(data.options.models)
     roles = tuple(data.options.roles)
     max_tokens = data.options.max_tokens
+    cell_timings: list[dict[str, float]] | None = [] if timing else None
+    profile_context = start_profile(profile, x_admin_key)
 
     try:
-        # agrid_query_geminiを呼び出して、複数の組み合わせで非同期に問い合わせる
-        results = await agrid_query_gemini(
-            q=data.q,
-            roles=roles,
-            model_names=model_names,
-            temperature=0.7,
-            max_tokens=max_tokens,
-        )
+        with profile_context as profile_id:
+            # agrid_query_geminiを呼び出して、複数の組み合わせで非同期に問い合わせる
+            results = await agrid_query_gemini(
+                q=data.q,
+                roles=roles,
+                model_names=model_names,
+                temperature=0.7,
+                max_tokens=max_tokens,
+                start=start,
+                stop=stop,
+                timings=cell_timings,
+            )
+    except RateLimitError as e:
+        raise rate_limit_exception(e) from e
     except ValueError as e:
         # Gemini APIの環境変数が設定されていない場合など
         raise HTTPException(status_code=500, detail=str(e))
     else:
+        timer.lap("query")
+        args_list = [args for _, args in results]
+        USAGE.record(caller_id(data.key), args_list)
         # 回答をMultiQueryItemに変換
         multi_query_items = []
-        for idx, (result, args) in enumerate(results, 1):
+        for idx, (result, args) in enumerate(results, start + 1):
             multi_query_items.append(
                 MultiQueryItem(
                     id=idx,
@@ -232,6 +559,256 @@ async def multi_async(data: MultiRequest):
         # 応答を作成
         response = MultiQueryResponse(
             data=multi_query_items,
-            meta={"duration": duration},
+            meta={
+                "duration": duration,
+                "usage": total_usage(args_list),
+                **page_meta(data, stop, total),
+            },
         )
+        timer.lap("response")
+        if cell_timings is not None:
+            response.meta["timing"] = {**timer.phases, "cells": cell_timings}
+            request.state.handler_done_at = time.perf_counter()
+        if profile_id is not None:
+            response.meta["profile_id"] = profile_id
         return response
+
+
+@app.get("/admin/profiles/{profile_id}")
+def download_profile(profile_id: str, x_admin_key: str | None = Header(None)):
+    """
+    取得したプロファイルをダウンロードするエンドポイント（管理者用）
+
+    引数:
+    - profile_id: プロファイルのID（meta.profile_id の値）
+    - X-Admin-Key ヘッダー: 管理者キー
+
+    戻り値:
+    - pstats 形式のファイル（`python -m pstats <ファイル名>` で閲覧できる）
+    """
+    if x_admin_key != ADMIN_KEY:
+        raise HTTPException(status_code=403, detail="管理者キーが無効です")
+    content = load_profile(profile_id, SHARED_STATE)
+    if content is None:
+        raise HTTPException(status_code=404, detail="プロファイルが見つかりません")
+    return Response(
+        content=content,
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="{profile_id}.prof"'},
+    )
+
+
+@app.get("/admin/usage", response_model=list[UsageSummary])
+def usage_summary(
+    caller: str | None = None,
+    model: str | None = None,
+    x_admin_key: str | None = Header(None),
+):
+    """
+    トークン使用量と概算費用を集計して返すエンドポイント（管理者用）
+
+    引数:
+    - caller: 呼び出し元のID（認証キーの SHA-256 の先頭12文字、省略可能）
+    - model: モデル名（省略可能）
+    - X-Admin-Key ヘッダー: 管理者キー
+
+    戻り値:
+    - UsageSummaryのリスト（呼び出し元・モデルごと）
+    """
+    if x_admin_key != ADMIN_KEY:
+        raise HTTPException(status_code=403, detail="管理者キーが無効です")
+    return USAGE.summary(caller=caller, model=model)
+
+
+async def ws_single(
+    message: WsSingleMessage, outbox: asyncio.Queue, caller: str
+) -> None:
+    """WebSocketの単一の問い合わせを実行し、結果を送信待ちに追加する"""
+    start_time = time.time()
+    options = message.options or Options()
+    try:
+        result, args = await aquery_gemini(
+            q=message.q,
+            role="あなたは親切なアシスタントです。",
+            model_name=options.model,
+            temperature=0.7,
+            max_tokens=options.max_tokens,
+        )
+    except Exception as e:
+        # Gemini APIのエラーなども、この問い合わせのエラーとして返す
+        await outbox.put({"id": message.id, "error": str(e)})
+        return
+    USAGE.record(caller, [args])
+    data = QueryResponse(result=result, args=args)
+    await outbox.put(
+        {
+            "id": message.id,
+            "data": data.model_dump(mode="json"),
+            "done": True,
+            "meta": {
+                "duration": time.time() - start_time,
+                "usage": total_usage([args]),
+            },
+        }
+    )
+
+
+async def ws_multi(message: WsMultiMessage, outbox: asyncio.Queue, caller: str) -> None:
+    """WebSocketの複数の問い合わせを実行し、終わった回答から送信待ちに追加する"""
+    start_time = time.time()
+    options = message.options
+    cells = grid_cells(options.roles, options.models)
+    total = len(options.models) * len(options.roles)
+
+    async def query_cell(
+        idx: int, model_name: AVAILABLE_MODELS, role: str
+    ) -> MultiQueryItem:
+        result, args = await aquery_gemini(
+            q=message.q,
+            role=role,
+            model_name=model_name,
+            temperature=0.7,
+            max_tokens=options.max_tokens,
+        )
+        return MultiQueryItem(id=idx, result=result, args=args)
+
+    args_list = []
+    idx = 0
+    while chunk := list(itertools.islice(cells, GRID_CHUNK_SIZE)):
+        tasks = []
+        for model_name, role in chunk:
+            idx += 1
+            tasks.append(asyncio.create_task(query_cell(idx, model_name, role)))
+        try:
+            for task in asyncio.as_completed(tasks):
+                item = await task
+                USAGE.record(caller, [item.args])
+                args_list.append(item.args)
+                await outbox.put(
+                    {"id": message.id, "item": item.model_dump(mode="json")}
+                )
+        except Exception as e:
+            # Gemini APIのエラーなども、この問い合わせのエラーとして返す
+            await outbox.put({"id": message.id, "error": str(e)})
+            return
+        finally:
+            # エラーやキャンセルの場合に、残りの組み合わせを止める
+            for task in tasks:
+                task.cancel()
+    await outbox.put(
+        {
+            "id": message.id,
+            "done": True,
+            "meta": {
+                "duration": time.time() - start_time,
+                "usage": total_usage(args_list),
+                "total": total,
+            },
+        }
+    )
+
+
+async def ws_handle(raw: str, outbox: asyncio.Queue, caller: str) -> None:
+    """WebSocketで受信したメッセージを検証して問い合わせを実行する
+
+    検証エラーの場合も、メッセージに id があればその id でエラーを返す
+    """
+    try:
+        message = WsMessage.validate_json(raw)
+    except ValidationError as e:
+        try:
+            payload = json.loads(raw)
+        except json.JSONDecodeError:
+            payload = None
+        message_id = payload.get("id") if isinstance(payload, dict) else None
+        if not isinstance(message_id, str | int):
+            message_id = None
+        await outbox.put({"id": message_id, "error": str(e)})
+        return
+    if isinstance(message, WsSingleMessage):
+        await ws_single(message, outbox, caller)
+    else:
+        await ws_multi(message, outbox, caller)
+
+
+@app.websocket("/ws")
+async def websocket_session(websocket: WebSocket):
+    """
+    複数の問い合わせを1つの接続で行う WebSocket エンドポイント
+
+    最初のメッセージで認証し、その後は問い合わせのメッセージを続けて送信できる
+    問い合わせは並行して処理し、終わったものから結果を送信する
+
+    受信メッセージ:
+    - 認証: {"key": 認証キー}（認証キーが無効な場合は接続を閉じる）
+    - 単一の問い合わせ: {"type": "single", "id": ID, "q": 質問, "options": Options}
+    - 複数の問い合わせ: {"type": "multi", "id": ID, "q": 質問, "options": MultiOptions}
+
+    送信メッセージ（id は問い合わせのメッセージの ID）:
+    - 単一の回答: {"id", "data": QueryResponse, "done": true, "meta"}
+    - 複数の回答の各アイテム: {"id", "item": MultiQueryItem}
+    - 複数の回答の完了: {"id", "done": true, "meta"}
+    - エラー: {"id", "error": エラーメッセージ}
+
+    同時に処理する問い合わせが WS_MAX_IN_FLIGHT 件に達するか、
+    クライアントの受信が遅れて送信待ちが WS_SEND_QUEUE_SIZE 件に達した場合は、
+    次のメッセージの受信を待たせる
+    """
+    await websocket.accept()
+
+    # 認証キーの確認
+    try:
+        auth = await websocket.receive_json()
+    except (KeyError, ValueError):
+        # バイナリのメッセージ（KeyError）や JSON でないメッセージは認証エラーにする
+        auth = None
+    if not isinstance(auth, dict) or auth.get("key") != AUTH_KEY:
+        await websocket.close(
+            code=status.WS_1008_POLICY_VIOLATION, reason="認証キーが無効です"
+        )
+        return
+    caller = caller_id(auth["key"])
+
+    outbox: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+    in_flight = asyncio.Semaphore(WS_MAX_IN_FLIGHT)
+    tasks: set[asyncio.Task] = set()
+
+    async def send_loop() -> None:
+        while True:
+            await websocket.send_json(await outbox.get())
+
+    async def handle(raw: str) -> None:
+        try:
+            await ws_handle(raw, outbox, caller)
+        finally:
+            in_flight.release()
+
+    async def receive_loop() -> None:
+        while True:
+            await in_flight.acquire()
+            try:
+                raw = await websocket.receive_text()
+            except KeyError:
+                # バイナリのメッセージは受け付けない
+                in_flight.release()
+                await outbox.put(
+                    {"id": None, "error": "テキストのメッセージを送信してください"}
+                )
+                continue
+            task = asyncio.create_task(handle(raw))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    # 送信と受信のどちらかが終了したら（切断や送信の失敗）、セッションを終了する
+    sender = asyncio.create_task(send_loop())
+    receiver = asyncio.create_task(receive_loop())
+    try:
+        done, _ = await asyncio.wait(
+            {sender, receiver}, return_when=asyncio.FIRST_COMPLETED
+        )
+    finally:
+        for task in (*tasks, sender, receiver):
+            task.cancel()
+    for task in done:
+        # 切断などによる例外は、セッションの終了として扱う
+        task.exception()
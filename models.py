@@ -1,7 +1,13 @@
 import enum
-from typing import Any, TypedDict
+import os
+from typing import Annotated, Any, Literal, NotRequired, Self, TypedDict
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter, model_validator
+
+# グリッド（モデル×役割）の上限値（環境変数で上書き可能）
+MAX_GRID_MODELS = int(os.getenv("MAX_GRID_MODELS", "10"))
+MAX_GRID_ROLES = int(os.getenv("MAX_GRID_ROLES", "50"))
+MAX_GRID_CELLS = int(os.getenv("MAX_GRID_CELLS", "100"))
 
 
 class AVAILABLE_MODELS(str, enum.Enum):
@@ -12,6 +18,14 @@ class AVAILABLE_MODELS(str, enum.Enum):
     GEMINI_2_5_FLASH = "gemini-2.5-flash-preview-05-20"
 
 
+class TokenUsage(TypedDict):
+    """1回の問い合わせで使用したトークン数"""
+
+    input_tokens: int
+    output_tokens: int
+    total_tokens: int
+
+
 class QueryArgs(TypedDict):
     """DeepSeek APIの戻り値を表す型"""
 
@@ -20,6 +34,8 @@ class QueryArgs(TypedDict):
     model_name: AVAILABLE_MODELS
     temperature: float
     max_tokens: int | None
+    # APIを呼び出した場合のみ（キャッシュから返した場合はなし）
+    usage: NotRequired[TokenUsage]
 
 
 class Options(BaseModel):
@@ -56,11 +72,15 @@ class MultiOptions(BaseModel):
         (AVAILABLE_MODELS.GEMINI_2_0_FLASH,),
         title="モデル名リスト",
         description="使用するモデルの名前のリスト",
+        min_length=1,
+        max_length=MAX_GRID_MODELS,
     )
     roles: tuple[str, ...] = Field(
         ("あなたは親切なアシスタントです。",),
         title="役割リスト",
         description="AIの役割を指定する文字列のリスト（例：初心者向け、弁護士風など）",
+        min_length=1,
+        max_length=MAX_GRID_ROLES,
     )
     max_tokens: int = Field(
         1024,
@@ -69,6 +89,23 @@ class MultiOptions(BaseModel):
         ge=128,
         le=4096,
     )
+    page_size: int | None = Field(
+        None,
+        title="ページサイズ",
+        description="1回の応答で返す回答の最大件数（省略時はすべて返す）",
+        ge=1,
+        le=MAX_GRID_CELLS,
+    )
+
+    @model_validator(mode="after")
+    def check_grid_size(self) -> Self:
+        """モデル数×役割数がグリッドの上限を超えていないか確認する"""
+        cells = len(self.models) * len(self.roles)
+        if cells > MAX_GRID_CELLS:
+            raise ValueError(
+                f"モデルと役割の組み合わせ数({cells})が上限({MAX_GRID_CELLS})を超えています"
+            )
+        return self
 
 
 class MultiRequest(BaseModel):
@@ -76,6 +113,11 @@ class MultiRequest(BaseModel):
 
     key: str = Field(..., description="認証キー")
     q: str = Field(..., description="質問文字列")
+    cursor: str | None = Field(
+        None,
+        title="カーソル",
+        description="前回の応答の meta.next_cursor（続きのページを取得する場合）",
+    )
     options: MultiOptions = Field(
         default_factory=lambda: MultiOptions(
             models=(AVAILABLE_MODELS.GEMINI_2_0_FLASH,),
@@ -114,3 +156,49 @@ class ApiResponse(BaseModel):
 
     data: QueryResponse
     meta: dict[str, Any]
+
+
+class UsageSummary(BaseModel):
+    """呼び出し元・モデルごとのトークン使用量の集計"""
+
+    caller: str = Field(..., description="呼び出し元（認証キーのハッシュ）")
+    model: str = Field(..., description="モデル名")
+    requests: int = Field(0, description="問い合わせ回数")
+    cached: int = Field(0, description="キャッシュから返した回数")
+    input_tokens: int = Field(0, description="入力トークン数の合計")
+    output_tokens: int = Field(0, description="出力トークン数の合計")
+    total_tokens: int = Field(0, description="トークン数の合計")
+    max_output_tokens: int = Field(0, description="1回の出力トークン数の最大値")
+    max_tokens_hits: int = Field(
+        0, description="出力トークン数が max_tokens に達した回数"
+    )
+    cost_usd: float = Field(0.0, description="概算費用（米ドル）")
+
+
+class WsSingleMessage(BaseModel):
+    """WebSocketでの単一の問い合わせメッセージ"""
+
+    type: Literal["single"]
+    id: str | int = Field(..., description="クライアントが指定するメッセージID")
+    q: str = Field(..., description="質問文字列")
+    options: Options | None = Field(
+        None, title="オプション設定", description="モデルやトークン数の設定"
+    )
+
+
+class WsMultiMessage(BaseModel):
+    """WebSocketでの複数の問い合わせメッセージ"""
+
+    type: Literal["multi"]
+    id: str | int = Field(..., description="クライアントが指定するメッセージID")
+    q: str = Field(..., description="質問文字列")
+    options: MultiOptions = Field(
+        default_factory=MultiOptions,
+        title="オプション設定",
+        description="モデル、役割、トークン数の設定",
+    )
+
+
+WsMessage = TypeAdapter(
+    Annotated[WsSingleMessage | WsMultiMessage, Field(discriminator="type")]
+)
@@ -0,0 +1,125 @@
+"""
+リクエストの処理時間を計測するモジュール
+
+このモジュールには2つの機能を持つ:
+- 処理の段階ごとの時間を記録する `PhaseTimer` クラス
+- リクエストを処理している間のプロセス全体の cProfile を取得して保存する
+  `ProcessProfile` クラス
+
+Python 3.12 以降の cProfile は sys.monitoring を使うため、有効にするとプロセス内の
+すべてのスレッド（同時に処理している他のリクエストを含む）が記録される。
+そのため、プロファイルは1リクエスト分ではなく、取得した時間帯のプロセス全体のものになる。
+
+複数ワーカーで動かす場合、プロファイルはリクエストを処理したワーカーのプロセスのもので、
+SharedState を指定するとワーカー間で共有するファイルに保存する（どのワーカーからでも
+ダウンロードできる）。指定しない場合はプロセス内の PROFILES に保存する。
+"""
+
+import cProfile
+import marshal
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from sharedstate import SharedState
+
+# 保存しておくプロファイルの最大件数（古いものから削除する）
+MAX_PROFILES = 20
+
+# プロファイルを取得する最大秒数（超えた場合は自動で停止してロックを解放する）
+MAX_PROFILE_SECONDS = 30.0
+
+PROFILES: OrderedDict[str, bytes] = OrderedDict()
+
+# cProfile は同時に1つしか有効にできないため、取得中かどうかを管理する
+_profile_lock = threading.Lock()
+
+
+class PhaseTimer:
+    """処理の段階ごとの時間（秒）を記録するクラス"""
+
+    def __init__(self, started_at: float | None = None) -> None:
+        """
+        Args:
+            started_at: 計測開始時刻（time.perf_counter の値、省略時は現在時刻）
+        """
+        self.phases: dict[str, float] = {}
+        self._last = time.perf_counter() if started_at is None else started_at
+
+    def lap(self, name: str, at: float | None = None) -> None:
+        """前回の記録から現在までの時間を name の段階として記録する
+
+        at（time.perf_counter の値）を指定した場合は at までの時間を記録する
+        """
+        now = time.perf_counter() if at is None else at
+        self.phases[name] = now - self._last
+        self._last = now
+
+
+class ProcessProfile:
+    """プロセス全体の cProfile を取得するコンテキストマネージャ
+
+    with 文の間（最大 MAX_PROFILE_SECONDS 秒）のプロセス全体を記録し、
+    停止するとプロファイルを pstats 形式で PROFILES（または state）に保存する
+    ほかのプロファイルを取得中の場合は生成時に RuntimeError を送出する
+    """
+
+    def __init__(self, state: SharedState | None = None) -> None:
+        """
+        Args:
+            state: プロファイルを保存する SharedState（省略時は PROFILES に保存する）
+        """
+        if not _profile_lock.acquire(blocking=False):
+            raise RuntimeError("別のプロファイルを取得中です")
+        self.state = state
+        self.profile_id = uuid.uuid4().hex
+        self.started_at = 0.0
+        self.stopped_at = 0.0
+        self._profiler = cProfile.Profile()
+        self._stop_lock = threading.Lock()
+        self._stopped = False
+        self._timer = threading.Timer(MAX_PROFILE_SECONDS, self.stop)
+        self._timer.daemon = True
+
+    def __enter__(self) -> str:
+        self.started_at = time.time()
+        self._profiler.enable()
+        self._timer.start()
+        return self.profile_id
+
+    def __exit__(self, *exc_info: object) -> None:
+        self._timer.cancel()
+        self.stop()
+
+    def stop(self) -> None:
+        """取得を停止してプロファイルを保存し、ロックを解放する（2回目以降は何もしない）"""
+        with self._stop_lock:
+            if self._stopped:
+                return
+            self._stopped = True
+        self._profiler.disable()
+        self.stopped_at = time.time()
+        _profile_lock.release()
+        self._profiler.create_stats()
+        # pstats.Stats(ファイル名) で読み込める形式（Profile.dump_stats と同じ）
+        stats = self._profiler.stats  # type: ignore[attr-defined]
+        data = marshal.dumps(stats)
+        if self.state is not None:
+            self.state.save_profile(self.profile_id, data, MAX_PROFILES)
+            return
+        PROFILES[self.profile_id] = data
+        while len(PROFILES) > MAX_PROFILES:
+            PROFILES.popitem(last=False)
+
+
+def load_profile(profile_id: str, state: SharedState | None = None) -> bytes | None:
+    """保存したプロファイルを pstats 形式で返す（なければ None）
+
+    Args:
+        profile_id: プロファイルのID
+        state: プロファイルを保存した SharedState（省略時は PROFILES から取得する）
+    """
+    if state is not None:
+        return state.load_profile(profile_id)
+    return PROFILES.get(profile_id)
@@ -0,0 +1,222 @@
+"""
+capture.py で記録したトラフィックを再生して負荷試験を行うモジュール
+
+使い方:
+    python replay.py capture.jsonl [--speed 1.0] [--model-latency 0.5]
+    python replay.py capture.jsonl --url http://127.0.0.1:8000 --key 認証キー
+
+--url を省略した場合は、このプロセス内でアプリを起動し、Gemini API の代わりに
+一定の時間待ってから回答を返すシミュレーション用のモデルを使用する。
+記録時と同じ間隔（--speed で倍率を指定）でリクエストを送信し、
+エンドポイントごとのレイテンシのパーセンタイルとエラー率を表示する。
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any
+
+import httpx
+from langchain_core.messages import AIMessage
+
+from capture import restore_body
+
+
+class SimulatedChat:
+    """ChatGoogleGenerativeAI の代わりに使うシミュレーション用のモデル
+
+    latency 秒（±50%）待ってから、max_tokens に応じた長さの回答を返す
+    """
+
+    latency = 0.5
+
+    def __init__(self, model, temperature, max_tokens) -> None:
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+
+    def invoke(self, messages) -> AIMessage:
+        """同期版の呼び出しをシミュレーションする"""
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+        input_tokens = sum(len(str(message.content)) for message in messages)
+        output_tokens = min(self.max_tokens or 256, 256)
+        return AIMessage(
+            content="シミュレーションの回答",
+            usage_metadata={
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+            },
+        )
+
+
+def iter_records(path: Path) -> Iterator[dict[str, Any]]:
+    """記録ファイルを1行ずつ読み込む（ボディを記録できなかった行は読み飛ばす）"""
+    with path.open(encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("body") is not None:
+                yield record
+
+
+def percentile(values: list[float], p: float) -> float:
+    """ソート済みの values の p パーセンタイル（最近傍順位法）"""
+    index = max(0, min(len(values) - 1, int(len(values) * p / 100 + 0.5) - 1))
+    return values[index]
+
+
+def summarize(results: list[tuple[str, float, int | None]]) -> dict[str, dict]:
+    """再生結果をエンドポイントごとに集計する
+
+    Args:
+        results: (パス, レイテンシ（秒）, ステータスコード) のリスト
+          （接続エラーなどの場合はステータスコードが None）
+
+    Returns:
+        dict[str, dict]: パスごと（全体は "all"）の件数、エラー率、パーセンタイル
+    """
+    groups: dict[str, list[tuple[float, int | None]]] = {"all": []}
+    for path, latency, status in results:
+        groups.setdefault(path, []).append((latency, status))
+        groups["all"].append((latency, status))
+
+    summary = {}
+    for path, items in groups.items():
+        if not items:
+            continue
+        latencies = sorted(latency for latency, _ in items)
+        errors = sum(1 for _, status in items if status is None or status >= 400)
+        summary[path] = {
+            "count": len(items),
+            "errors": errors,
+            "error_rate": errors / len(items),
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1],
+        }
+    return summary
+
+
+async def send(
+    client: httpx.AsyncClient, record: dict[str, Any], key: str
+) -> tuple[str, float, int | None]:
+    """記録した1件のリクエストを送信する"""
+    url = record["path"]
+    if record.get("query"):
+        url += "?" + record["query"]
+    started_at = time.perf_counter()
+    try:
+        response = await client.post(
+            url, json=restore_body(record["body"], key, record.get("status"))
+        )
+        status: int | None = response.status_code
+    except httpx.HTTPError:
+        status = None
+    return record["path"], time.perf_counter() - started_at, status
+
+
+async def replay(
+    path: Path, client: httpx.AsyncClient, key: str, speed: float = 1.0
+) -> list[tuple[str, float, int | None]]:
+    """記録したリクエストを記録時の間隔で送信する
+
+    応答を待たずに次のリクエストを送信する（記録時と同じ到着間隔を再現する）
+
+    Args:
+        path: 記録ファイルのパス
+        client: 送信に使う HTTP クライアント
+        key: 認証キー
+        speed: 再生速度の倍率（2.0 なら記録時の2倍の速さ）
+
+    Returns:
+        list[tuple[str, float, int | None]]: (パス, レイテンシ（秒）, ステータスコード)
+    """
+    started_at = time.perf_counter()
+    first_t = None
+    tasks = []
+    for record in iter_records(path):
+        if first_t is None:
+            first_t = record["t"]
+        delay = (record["t"] - first_t) / speed - (time.perf_counter() - started_at)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(client, record, key)))
+    return list(await asyncio.gather(*tasks))
+
+
+def print_summary(summary: dict[str, dict]) -> None:
+    """集計結果を表形式で表示する"""
+    print(
+        f"{'path':<14}{'count':>7}{'errors':>8}{'err%':>7}"
+        f"{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}"
+    )
+    for path, row in summary.items():
+        print(
+            f"{path:<14}{row['count']:>7}{row['errors']:>8}"
+            f"{row['error_rate'] * 100:>6.1f}%"
+            f"{row['p50']:>9.3f}{row['p90']:>9.3f}{row['p99']:>9.3f}{row['max']:>9.3f}"
+        )
+
+
+async def run(args: argparse.Namespace) -> dict[str, dict]:
+    """コマンドライン引数に従って再生し、集計結果を返す"""
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=None)
+        key = args.key
+    else:
+        import main
+        import searchapi
+
+        SimulatedChat.latency = args.model_latency
+        searchapi.ChatGoogleGenerativeAI = SimulatedChat  # type: ignore[assignment, misc]
+        searchapi.HAS_API_KEY = True
+        client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=main.app),
+            base_url="http://replay",
+            timeout=None,
+        )
+        key = args.key or main.AUTH_KEY
+
+    async with client:
+        results = await replay(args.capture, client, key, args.speed)
+    return summarize(results)
+
+
+def main() -> None:
+    """コマンドラインのエントリーポイント"""
+    parser = argparse.ArgumentParser(
+        description="記録したトラフィックを再生して負荷試験を行う"
+    )
+    parser.add_argument("capture", type=Path, help="capture.py で記録したファイル")
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="再生速度の倍率（デフォルト: 1.0）"
+    )
+    parser.add_argument(
+        "--url", help="送信先のURL（省略時はプロセス内のアプリに送信する）"
+    )
+    parser.add_argument("--key", help="認証キー（省略時は main.AUTH_KEY）")
+    parser.add_argument(
+        "--model-latency",
+        type=float,
+        default=0.5,
+        help="シミュレーション用のモデルの応答時間（秒、デフォルト: 0.5）",
+    )
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed は0より大きい値を指定してください")
+    if args.url and not args.key:
+        parser.error("--url を指定する場合は --key も指定してください")
+
+    print_summary(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
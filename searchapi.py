@@ -5,16 +5,23 @@ Gemini APIに対して問い合わせを行うモジュール
 - 一つの問い合わせだけを行う `query_gemini` 関数
 - 複数の問い合わせを実行する `grid_query_gemini` 関数
 - 複数の問い合わせを非同期に実行する `agrid_query_gemini` 関数
+
+複数の問い合わせは `grid_cells` 関数で (モデル名, 役割) の組み合わせを
+順に生成し、`start` / `stop` で範囲を指定して一部だけを実行できる。
 """
 
 import asyncio
+import itertools
 import logging
 import os
+import time
+from collections.abc import Iterator
 
 from langchain_core.messages import HumanMessage, SystemMessage
 from langchain_google_genai import ChatGoogleGenerativeAI
 
 from models import AVAILABLE_MODELS, QueryArgs
+from sharedstate import SharedState, make_key
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -29,6 +36,50 @@ if os.getenv("GOOGLE_API_KEY") is None:
 else:
     HAS_API_KEY = True
 
+# 非同期の複数問い合わせで同時に実行する件数
+GRID_CHUNK_SIZE = int(os.getenv("GRID_CHUNK_SIZE", "10"))
+if GRID_CHUNK_SIZE < 1:
+    # 0 以下では1件も問い合わせずに空の結果を返してしまう
+    raise ValueError(f"GRID_CHUNK_SIZE は1以上を指定してください（{GRID_CHUNK_SIZE}）")
+
+# ワーカープロセス間で共有するキャッシュとレート制限（SHARED_STATE_PATH 指定時のみ）
+SHARED_STATE: SharedState | None = None
+if os.getenv("SHARED_STATE_PATH"):
+    SHARED_STATE = SharedState(
+        os.environ["SHARED_STATE_PATH"],
+        cache_ttl=float(os.getenv("SHARED_CACHE_TTL", "300")),
+        rate_per_minute=(
+            float(os.environ["RATE_LIMIT_PER_MINUTE"])
+            if os.getenv("RATE_LIMIT_PER_MINUTE")
+            else None
+        ),
+        rate_timeout=float(os.getenv("RATE_LIMIT_WAIT", "0")),
+        coalesce_timeout=float(os.getenv("SHARED_COALESCE_TIMEOUT", "5")),
+    )
+
+
+def grid_cells(
+    roles: tuple[str, ...],
+    model_names: tuple[AVAILABLE_MODELS, ...],
+    start: int = 0,
+    stop: int | None = None,
+) -> Iterator[tuple[AVAILABLE_MODELS, str]]:
+    """モデル名と役割の組み合わせを順に生成する関数
+
+    モデル名ごとに役割を走査する順番で生成し、`start` から `stop` の範囲だけを返す
+
+    Args:
+        roles: 役割(System引数)のタプル
+        model_names: モデル名のタプル
+        start: 開始位置（0から始まるインデックス）
+        stop: 終了位置（省略時は最後まで）
+
+    Returns:
+        Iterator[tuple[AVAILABLE_MODELS, str]]: (モデル名, 役割) のイテレータ
+    """
+    cells = itertools.product(model_names, roles)
+    return itertools.islice(cells, start, stop)
+
 
 def query_gemini(
     q: str,
@@ -36,6 +87,7 @@ def query_gemini(
     model_name: AVAILABLE_MODELS,
     temperature: float,
     max_tokens: int | None = None,
+    timings: dict[str, float] | None = None,
 ) -> tuple[str, QueryArgs]:
     """Gemini APIに単一の問い合わせを行う関数
 
@@ -45,21 +97,20 @@ def query_gemini(
         model_name: モデル名
         temperature: ランダムさ
         max_tokens: トークン数（省略可能）
+        timings: 処理時間（秒）を書き込む辞書（省略可能）
+          - client: クライアントの生成
+          - upstream: APIの呼び出し
 
     Returns:
         tuple[str, Dict[str, Union[str, int, float, None]]]:
           - APIからの戻り文字列
-          - 引数の値をオブジェクトで返す
+          - 引数の値をオブジェクトで返す（APIを呼び出した場合は usage を含む）
+
+    SHARED_STATE が設定されている場合は、ワーカープロセス間で共有するキャッシュを使い、
+    同じ問い合わせが実行中であればその結果を待つ
     """
     if not HAS_API_KEY:
         raise ValueError("GOOGLE_API_KEY 環境変数が設定されていません。")
-    chat = ChatGoogleGenerativeAI(
-        model=model_name, temperature=temperature, max_tokens=max_tokens
-    )
-
-    messages = [SystemMessage(content=role), HumanMessage(content=q)]
-
-    result = chat.invoke(messages)
 
     args_dict: QueryArgs = {
         "query": q,
@@ -69,8 +120,41 @@ def query_gemini(
         "max_tokens": max_tokens,
     }
 
-    # result.contentをstr型に確実に変換
-    content_str = str(result.content)
+    def invoke() -> str:
+        started_at = time.perf_counter()
+        chat = ChatGoogleGenerativeAI(
+            model=model_name, temperature=temperature, max_tokens=max_tokens
+        )
+        created_at = time.perf_counter()
+
+        messages = [SystemMessage(content=role), HumanMessage(content=q)]
+
+        result = chat.invoke(messages)
+
+        if timings is not None:
+            timings["client"] = created_at - started_at
+            timings["upstream"] = time.perf_counter() - created_at
+
+        # トークン使用量を記録（キャッシュから返した場合は記録されない）
+        usage = getattr(result, "usage_metadata", None)
+        if isinstance(usage, dict):
+            args_dict["usage"] = {
+                "input_tokens": usage.get("input_tokens", 0),
+                "output_tokens": usage.get("output_tokens", 0),
+                "total_tokens": usage.get("total_tokens", 0),
+            }
+
+        # result.contentをstr型に確実に変換
+        return str(result.content)
+
+    if SHARED_STATE is None:
+        content_str = invoke()
+    else:
+        content_str = SHARED_STATE.get_or_compute(
+            make_key(**args_dict),
+            invoke,
+            rate_key=str(getattr(model_name, "value", model_name)),
+        )
     return content_str, args_dict
 
 
@@ -80,6 +164,9 @@ def grid_query_gemini(
     model_names: tuple[AVAILABLE_MODELS, ...],
     temperature: float,
     max_tokens: int | None = None,
+    start: int = 0,
+    stop: int | None = None,
+    timings: list[dict[str, float]] | None = None,
 ) -> list[tuple[str, QueryArgs]]:
     """Gemini APIに複数の問い合わせを行う関数
 
@@ -91,6 +178,9 @@ def grid_query_gemini(
         model_names: モデル名のタプル
         temperature: ランダムさ
         max_tokens: トークン数（省略可能）
+        start: 問い合わせる組み合わせの開始位置（省略可能）
+        stop: 問い合わせる組み合わせの終了位置（省略可能）
+        timings: 組み合わせごとの処理時間を追加するリスト（省略可能）
 
     Returns:
         List[Tuple[str, Dict[str, Union[str, int, float, None]]]]:
@@ -100,16 +190,20 @@ def grid_query_gemini(
         raise ValueError("GOOGLE_API_KEY 環境変数が設定されていません。")
     results = []
 
-    for model_name in model_names:
-        for role in roles:
-            result, args = query_gemini(
-                q=q,
-                role=role,
-                model_name=model_name,
-                temperature=temperature,
-                max_tokens=max_tokens,
-            )
-            results.append((result, args))
+    for model_name, role in grid_cells(roles, model_names, start, stop):
+        cell_timings: dict[str, float] | None = None
+        if timings is not None:
+            cell_timings = {}
+            timings.append(cell_timings)
+        result, args = query_gemini(
+            q=q,
+            role=role,
+            model_name=model_name,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            timings=cell_timings,
+        )
+        results.append((result, args))
 
     return results
 
@@ -120,6 +214,7 @@ async def aquery_gemini(
     model_name: AVAILABLE_MODELS,
     temperature: float,
     max_tokens: int | None = None,
+    timings: dict[str, float] | None = None,
 ) -> tuple[str, QueryArgs]:
     """Gemini APIに単一の問い合わせを非同期で行う関数
 
@@ -131,6 +226,8 @@ async def aquery_gemini(
         model_name: モデル名
         temperature: ランダムさ
         max_tokens: トークン数（省略可能）
+        timings: 処理時間（秒）を書き込む辞書（省略可能）
+          query_gemini関数の項目に加え、queue（スレッドの空き待ち）を書き込む
 
     Returns:
         tuple[str, Dict[str, Union[str, int, float, None]]]:
@@ -139,16 +236,15 @@ async def aquery_gemini(
     if not HAS_API_KEY:
         raise ValueError("GOOGLE_API_KEY 環境変数が設定されていません。")
 
+    submitted_at = time.perf_counter()
+
+    def run() -> tuple[str, QueryArgs]:
+        if timings is not None:
+            timings["queue"] = time.perf_counter() - submitted_at
+        return query_gemini(q, role, model_name, temperature, max_tokens, timings)
+
     loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(
-        None,
-        query_gemini,
-        q,
-        role,
-        model_name,
-        temperature,
-        max_tokens,
-    )
+    return await loop.run_in_executor(None, run)
 
 
 async def agrid_query_gemini(
@@ -157,10 +253,15 @@ async def agrid_query_gemini(
     model_names: tuple[AVAILABLE_MODELS, ...],
     temperature: float,
     max_tokens: int | None = None,
+    start: int = 0,
+    stop: int | None = None,
+    chunk_size: int | None = None,
+    timings: list[dict[str, float]] | None = None,
 ) -> list[tuple[str, QueryArgs]]:
     """Gemini APIに複数の問い合わせを非同期で実行する関数
 
     grid_query_gemini関数の非同期版関数
+    同時に実行する問い合わせは `chunk_size` 件ずつに分けて実行する
 
     Args:
         q: クエリ文字列
@@ -168,6 +269,10 @@ async def agrid_query_gemini(
         model_names: モデル名のタプル
         temperature: ランダムさ
         max_tokens: トークン数（省略可能）
+        start: 問い合わせる組み合わせの開始位置（省略可能）
+        stop: 問い合わせる組み合わせの終了位置（省略可能）
+        chunk_size: 同時に実行する件数（省略時は GRID_CHUNK_SIZE）
+        timings: 組み合わせごとの処理時間を追加するリスト（省略可能）
 
     Returns:
         List[Tuple[str, Dict[str, Union[str, int, float, None]]]]:
@@ -175,20 +280,30 @@ async def agrid_query_gemini(
     """
     if not HAS_API_KEY:
         raise ValueError("GOOGLE_API_KEY 環境変数が設定されていません。")
-    tasks = []
+    if chunk_size is None:
+        chunk_size = GRID_CHUNK_SIZE
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size は1以上を指定してください（{chunk_size}）")
+    cells = grid_cells(roles, model_names, start, stop)
+    results = []
 
-    for model_name in model_names:
-        for role in roles:
+    # chunk_size件ずつ並列に実行して結果を待つ
+    while chunk := list(itertools.islice(cells, chunk_size)):
+        tasks = []
+        for model_name, role in chunk:
+            cell_timings: dict[str, float] | None = None
+            if timings is not None:
+                cell_timings = {}
+                timings.append(cell_timings)
             task = aquery_gemini(
                 q=q,
                 role=role,
                 model_name=model_name,
                 temperature=temperature,
                 max_tokens=max_tokens,
+                timings=cell_timings,
             )
             tasks.append(task)
-
-    # 並列に実行して結果を待つ
-    results = await asyncio.gather(*tasks)
+        results.extend(await asyncio.gather(*tasks))
 
     return results
@@ -0,0 +1,331 @@
+"""
+複数のワーカープロセスで状態を共有するモジュール
+
+uvicorn を複数ワーカーで動かすと、プロセスごとの状態はワーカー数だけ別々になる。
+このモジュールでは SQLite ファイルを介して、同じホストのプロセス間で次を共有する:
+- レート制限の残り回数（トークンバケット）
+- 同じ問い合わせの実行中の状態（同時に来た同じ問い合わせは1回だけ実行する）
+- 回答のキャッシュ
+- 呼び出し元・モデルごとのトークン使用量の集計
+- 取得したプロファイル（どのワーカーからでもダウンロードできるようにする）
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from typing import Any
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at);
+CREATE TABLE IF NOT EXISTS inflight (
+    key TEXT PRIMARY KEY,
+    started_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rate_limits (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS usage (
+    caller TEXT NOT NULL,
+    model TEXT NOT NULL,
+    requests INTEGER NOT NULL,
+    cached INTEGER NOT NULL,
+    input_tokens INTEGER NOT NULL,
+    output_tokens INTEGER NOT NULL,
+    total_tokens INTEGER NOT NULL,
+    max_output_tokens INTEGER NOT NULL,
+    max_tokens_hits INTEGER NOT NULL,
+    cost_usd REAL NOT NULL,
+    PRIMARY KEY (caller, model)
+);
+CREATE TABLE IF NOT EXISTS profiles (
+    id TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+# usage テーブルの集計値の列（max_output_tokens 以外は加算する）
+USAGE_COLUMNS = (
+    "requests",
+    "cached",
+    "input_tokens",
+    "output_tokens",
+    "total_tokens",
+    "max_output_tokens",
+    "max_tokens_hits",
+    "cost_usd",
+)
+
+
+class RateLimitError(Exception):
+    """レート制限を超えた場合の例外
+
+    Attributes:
+        retry_after: 次にトークンを取得できるまでの秒数
+    """
+
+    def __init__(self, key: str, retry_after: float) -> None:
+        super().__init__(f"レート制限を超えました（{key}）")
+        self.retry_after = retry_after
+
+
+def make_key(**kwargs: Any) -> str:
+    """引数の値からキャッシュのキーを作る関数"""
+    payload = json.dumps(kwargs, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class SharedState:
+    """SQLite ファイルでプロセス間の状態を共有するクラス
+
+    接続はスレッドごとに作成するので、スレッドやプロセスをまたいで使用できる
+    """
+
+    def __init__(
+        self,
+        path: str,
+        cache_ttl: float = 300.0,
+        rate_per_minute: float | None = None,
+        rate_timeout: float = 0.0,
+        coalesce_timeout: float = 5.0,
+        inflight_timeout: float = 120.0,
+        poll_interval: float = 0.05,
+    ) -> None:
+        """
+        待ち時間はスレッドを止めるため（非同期の問い合わせではスレッドプールを占有する）、
+        デフォルトではレート制限は待たずにエラーにし、実行中の問い合わせも短時間だけ待つ
+
+        Args:
+            path: SQLite ファイルのパス
+            cache_ttl: 回答をキャッシュする秒数
+            rate_per_minute: レート制限のキーごとの1分あたりの上限（省略時は制限なし）
+            rate_timeout: レート制限で待つ最大秒数（0 の場合は待たずにエラー）
+            coalesce_timeout: 他のプロセスが実行中の同じ問い合わせを待つ最大秒数
+              （超えた場合は待たずに自分で実行する）
+            inflight_timeout: 実行中とみなす最大秒数
+              （超えた場合は実行中のプロセスが落ちたとみなす）
+            poll_interval: 実行中の問い合わせの完了を確認する間隔（秒）
+        """
+        self.path = path
+        self.cache_ttl = cache_ttl
+        self.rate_per_minute = rate_per_minute
+        self.rate_timeout = rate_timeout
+        self.coalesce_timeout = coalesce_timeout
+        self.inflight_timeout = inflight_timeout
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._connect().executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        """このスレッド用の接続を返す"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """書き込みロックを取ってトランザクションを実行する"""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    def cache_get(self, key: str) -> str | None:
+        """キャッシュから値を取得する（なければ None）"""
+        row = (
+            self._connect()
+            .execute(
+                "SELECT value FROM cache WHERE key = ? AND expires_at > ?",
+                (key, time.time()),
+            )
+            .fetchone()
+        )
+        return None if row is None else row[0]
+
+    def cache_set(self, key: str, value: str) -> None:
+        """キャッシュに値を保存し、期限切れの値を削除する"""
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                (key, value, now + self.cache_ttl),
+            )
+            conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+
+    def try_acquire_token(self, key: str) -> float:
+        """レート制限のトークンを1つ取得する
+
+        Returns:
+            float: 取得できた場合は 0、できなかった場合は次に取得できるまでの秒数
+        """
+        if self.rate_per_minute is None:
+            return 0.0
+        rate = self.rate_per_minute / 60
+        capacity = self.rate_per_minute
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT tokens, updated_at FROM rate_limits WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                tokens = capacity
+            else:
+                tokens = min(capacity, row[0] + (now - row[1]) * rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / rate
+            conn.execute(
+                "INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?)",
+                (key, tokens, now),
+            )
+        return wait
+
+    def wait_for_token(self, key: str) -> None:
+        """レート制限のトークンを取得できるまで待つ
+
+        rate_timeout 秒以内に取得できない場合は RateLimitError を送出する
+        """
+        deadline = time.monotonic() + self.rate_timeout
+        while (wait := self.try_acquire_token(key)) > 0:
+            remaining = deadline - time.monotonic()
+            if wait > remaining:
+                raise RateLimitError(key, retry_after=wait)
+            time.sleep(wait)
+
+    def add_usage(self, caller: str, model: str, values: dict[str, Any]) -> None:
+        """呼び出し元・モデルごとのトークン使用量を集計に加える
+
+        Args:
+            caller: 呼び出し元のID
+            model: モデル名
+            values: USAGE_COLUMNS の列ごとの値
+        """
+        updates = ", ".join(
+            f"{column} = MAX({column}, excluded.{column})"
+            if column == "max_output_tokens"
+            else f"{column} = {column} + excluded.{column}"
+            for column in USAGE_COLUMNS
+        )
+        with self._transaction() as conn:
+            conn.execute(
+                f"INSERT INTO usage VALUES (?, ?{', ?' * len(USAGE_COLUMNS)})"
+                f" ON CONFLICT (caller, model) DO UPDATE SET {updates}",
+                (caller, model, *(values[column] for column in USAGE_COLUMNS)),
+            )
+
+    def usage_rows(
+        self, caller: str | None = None, model: str | None = None
+    ) -> list[dict[str, Any]]:
+        """トークン使用量の集計を返す（caller や model を指定した場合は絞り込む）"""
+        rows = self._connect().execute(
+            "SELECT caller, model, " + ", ".join(USAGE_COLUMNS) + " FROM usage"
+            " WHERE (? IS NULL OR caller = ?) AND (? IS NULL OR model = ?)"
+            " ORDER BY caller, model",
+            (caller, caller, model, model),
+        )
+        return [
+            dict(zip(("caller", "model", *USAGE_COLUMNS), row, strict=True))
+            for row in rows
+        ]
+
+    def save_profile(self, profile_id: str, data: bytes, max_profiles: int) -> None:
+        """プロファイルを保存し、新しいものから max_profiles 件だけ残す"""
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO profiles VALUES (?, ?, ?)",
+                (profile_id, data, time.time()),
+            )
+            conn.execute(
+                "DELETE FROM profiles WHERE id NOT IN"
+                " (SELECT id FROM profiles ORDER BY created_at DESC LIMIT ?)",
+                (max_profiles,),
+            )
+
+    def load_profile(self, profile_id: str) -> bytes | None:
+        """プロファイルを取得する（なければ None）"""
+        row = (
+            self._connect()
+            .execute("SELECT data FROM profiles WHERE id = ?", (profile_id,))
+            .fetchone()
+        )
+        return None if row is None else row[0]
+
+    def _claim(self, key: str) -> bool:
+        """問い合わせの実行権を取得する（他のプロセスが実行中なら False）"""
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT started_at FROM inflight WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[0] > now - self.inflight_timeout:
+                return False
+            conn.execute("INSERT OR REPLACE INTO inflight VALUES (?, ?)", (key, now))
+        return True
+
+    def _release(self, key: str) -> None:
+        """問い合わせの実行権を手放す"""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM inflight WHERE key = ?", (key,))
+
+    def get_or_compute(
+        self, key: str, compute: Callable[[], str], rate_key: str
+    ) -> str:
+        """キャッシュの値を返し、なければ compute を実行して保存する
+
+        同じキーを他のスレッドやプロセスが実行中の場合は、その結果を
+        coalesce_timeout 秒まで待つ（超えた場合は自分でも実行する）
+        compute の実行前に rate_key のレート制限のトークンを取得する
+
+        Args:
+            key: キャッシュのキー
+            compute: 値を求める関数
+            rate_key: レート制限のキー
+
+        Returns:
+            str: キャッシュの値または compute の戻り値
+        """
+        deadline = time.monotonic() + self.coalesce_timeout
+        claimed = False
+        while (value := self.cache_get(key)) is None:
+            if self._claim(key):
+                claimed = True
+                break
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(self.poll_interval)
+        else:
+            return value
+
+        try:
+            # 実行権を取得する直前に他のプロセスが保存した場合
+            if (value := self.cache_get(key)) is not None:
+                return value
+            self.wait_for_token(rate_key)
+            value = compute()
+            self.cache_set(key, value)
+        finally:
+            if claimed:
+                self._release(key)
+        return value
@@ -0,0 +1,131 @@
+"""
+batch モジュールのテスト
+"""
+
+import asyncio
+import json
+
+import pytest
+
+from batch import load_completed, run_batch
+from searchapi import QueryArgs
+
+
+@pytest.fixture
+def mock_aquery_gemini(monkeypatch):
+    """aquery_gemini 関数をモックし、呼び出された引数を記録する"""
+    calls = []
+
+    async def mock_aquery(q, role, model_name, temperature, max_tokens):
+        calls.append((q, model_name, role))
+        args = QueryArgs(
+            query=q,
+            role=role,
+            model_name=model_name,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+        return f"{q}:{role}", args
+
+    monkeypatch.setattr("batch.aquery_gemini", mock_aquery)
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_run_batch(tmp_path, mock_aquery_gemini):
+    """run_batch 関数のテスト"""
+    input_path = tmp_path / "input.jsonl"
+    output_path = tmp_path / "output.jsonl"
+    input_path.write_text(
+        "\n".join(
+            [
+                json.dumps({"id": "a", "q": "質問A", "roles": ["役割1", "役割2"]}),
+                json.dumps({"q": "質問B"}),
+                "不正な行",
+                "[1]",
+                "2",
+            ]
+        ),
+        encoding="utf-8",
+    )
+
+    written = await run_batch(input_path, output_path, concurrency=2)
+
+    # 不正な行を除いたすべての組み合わせが書き込まれることを検証
+    assert written == 3
+    records = [json.loads(line) for line in output_path.read_text().splitlines()]
+    assert {(r["id"], r["cell"]) for r in records} == {("a", 1), ("a", 2), ("2", 1)}
+    for r in records:
+        assert r["result"] == f"{r['args']['query']}:{r['args']['role']}"
+
+
+@pytest.mark.asyncio
+async def test_run_batch_resume(tmp_path, mock_aquery_gemini):
+    """run_batch 関数のテスト（途中から再開）"""
+    input_path = tmp_path / "input.jsonl"
+    output_path = tmp_path / "output.jsonl"
+    input_path.write_text(
+        json.dumps({"id": "a", "q": "質問A", "roles": ["役割1", "役割2", "役割3"]}),
+        encoding="utf-8",
+    )
+    # 1件目は回答済み、2件目はエラー、3件目は書きかけの状態
+    output_path.write_text(
+        json.dumps({"id": "a", "cell": 1, "result": "回答済み", "args": {}})
+        + "\n"
+        + json.dumps({"id": "a", "cell": 2, "error": "エラー"})
+        + "\n"
+        + "1\n"
+        + json.dumps({"result": "id のない行"})
+        + "\n"
+        + '{"id": "a", "cell": 3, "res',
+        encoding="utf-8",
+    )
+
+    written = await run_batch(input_path, output_path)
+
+    # 回答済みの組み合わせは問い合わせないことを検証
+    assert written == 2
+    assert sorted(role for _, _, role in mock_aquery_gemini) == ["役割2", "役割3"]
+    assert load_completed(output_path).completed_cells("a") == {1, 2, 3}
+
+
+@pytest.mark.asyncio
+async def test_run_batch_duplicate_id(tmp_path, mock_aquery_gemini):
+    """run_batch 関数のテスト（質問IDの重複）"""
+    input_path = tmp_path / "input.jsonl"
+    output_path = tmp_path / "output.jsonl"
+    input_path.write_text(
+        json.dumps({"id": "a", "q": "質問A"})
+        + "\n"
+        + json.dumps({"id": "a", "q": "質問B"}),
+        encoding="utf-8",
+    )
+
+    written = await run_batch(input_path, output_path)
+
+    # 2行目は重複として読み飛ばされることを検証
+    assert written == 1
+    assert [q for q, _, _ in mock_aquery_gemini] == ["質問A"]
+
+
+@pytest.mark.asyncio
+async def test_run_batch_write_error(tmp_path, monkeypatch):
+    """run_batch 関数のテスト（書き込みに失敗した場合は止まらずに例外を送出する）"""
+    input_path = tmp_path / "input.jsonl"
+    output_path = tmp_path / "output.jsonl"
+    input_path.write_text(
+        "\n".join(json.dumps({"id": str(i), "q": "質問"}) for i in range(5)),
+        encoding="utf-8",
+    )
+
+    async def mock_aquery(**kwargs):
+        # JSON に変換できない回答
+        return object(), {}
+
+    monkeypatch.setattr("batch.aquery_gemini", mock_aquery)
+
+    with pytest.raises(ExceptionGroup) as e:
+        await asyncio.wait_for(
+            run_batch(input_path, output_path, concurrency=1), timeout=3
+        )
+    assert e.group_contains(TypeError)
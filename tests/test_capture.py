@@ -0,0 +1,94 @@
+"""
+capture モジュールと replay モジュールのテスト
+"""
+
+import json
+
+import httpx
+import pytest
+
+import main
+from capture import INVALID_KEY, TrafficRecorder, restore_body, shape_body
+from replay import SimulatedChat, replay, summarize
+
+
+def test_shape_body():
+    """shape_body 関数と restore_body 関数のテスト"""
+    body = json.dumps({"key": "秘密", "q": "質問です", "options": {"max_tokens": 256}})
+
+    shape = shape_body(body.encode(), hash_questions=True)
+    assert "key" not in shape
+    assert shape["q"].startswith("sha256:")
+    assert shape["q_len"] == 4
+    assert shape["options"] == {"max_tokens": 256}
+
+    restored = restore_body(shape, "キー")
+    assert restored == {"key": "キー", "q": "ああああ", "options": {"max_tokens": 256}}
+    # 記録時に認証エラーだった場合は無効な認証キーにする
+    assert restore_body(shape, "キー", status=401)["key"] == INVALID_KEY
+
+    assert shape_body(body.encode(), hash_questions=False)["q"] == "質問です"
+    assert shape_body(b"invalid", hash_questions=False) is None
+
+
+def test_traffic_recorder(tmp_path):
+    """TrafficRecorder クラスのテスト（書き込みスレッドと close）"""
+    path = tmp_path / "capture.jsonl"
+    recorder = TrafficRecorder(str(path))
+    recorder.record(1.0, "/single", "", b'{"key": "k", "q": "q"}', 200, 0.1)
+    recorder.flush()
+    (record,) = [json.loads(line) for line in path.read_text().splitlines()]
+    assert record["body"] == {"q": "q"}
+
+    recorder.record(2.0, "/single", "", b"{}", 200, 0.1)
+    recorder.close()
+    assert len(path.read_text().splitlines()) == 2
+    # close 後の記録は無視する
+    recorder.record(3.0, "/single", "", b"{}", 200, 0.1)
+    recorder.close()
+    assert len(path.read_text().splitlines()) == 2
+
+
+def test_summarize():
+    """summarize 関数のテスト"""
+    summary = summarize(
+        [("/single", 0.1, 200), ("/single", 0.3, 500), ("/multi", 0.2, None)]
+    )
+    assert summary["all"]["count"] == 3
+    assert summary["all"]["errors"] == 2
+    assert summary["/single"]["error_rate"] == 0.5
+    assert summary["/single"]["p50"] == 0.1
+    assert summary["/single"]["max"] == 0.3
+
+
+@pytest.mark.asyncio
+async def test_capture_and_replay(monkeypatch, tmp_path):
+    """記録したトラフィックをシミュレーション用のモデルで再生するテスト"""
+    capture_path = tmp_path / "capture.jsonl"
+    recorder = TrafficRecorder(str(capture_path), True)
+    monkeypatch.setattr("main.CAPTURE", recorder)
+    monkeypatch.setattr("searchapi.ChatGoogleGenerativeAI", SimulatedChat)
+    monkeypatch.setattr("searchapi.HAS_API_KEY", True)
+    monkeypatch.setattr(SimulatedChat, "latency", 0.01)
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        await client.post("/single", json={"key": main.AUTH_KEY, "q": "質問1"})
+        await client.post(
+            "/multi-async",
+            json={"key": main.AUTH_KEY, "q": "質問2", "options": {"roles": ["a", "b"]}},
+        )
+        await client.post("/single", json={"key": "invalid_key", "q": "質問3"})
+        await client.get("/")
+
+        # 再生したリクエストは記録しない
+        recorder.close()
+        monkeypatch.setattr("main.CAPTURE", None)
+        records = [json.loads(line) for line in capture_path.read_text().splitlines()]
+        assert [r["status"] for r in records] == [200, 200, 401]
+        assert all("key" not in r["body"] for r in records)
+
+        results = await replay(capture_path, client, main.AUTH_KEY, speed=100)
+
+    # 記録時と同じステータスになる（認証エラーは無効な認証キーで再生する）
+    assert [status for _, _, status in results] == [200, 200, 401]
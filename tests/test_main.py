@@ -2,10 +2,17 @@
 main モジュールのテスト
 """
 
+import asyncio
+import json
+
+import pytest
+from fastapi import WebSocketDisconnect
 from fastapi.testclient import TestClient
 
-from main import AUTH_KEY, app
+from main import ADMIN_KEY, AUTH_KEY, app, websocket_session
 from searchapi import QueryArgs
+from sharedstate import RateLimitError
+from usage import UsageLedger, caller_id
 
 client = TestClient(app)
 
@@ -90,3 +97,368 @@ def test_single_endpoint_invalid_auth():
     assert response.json()["detail"] == "認証キーが無効です"
     # 認証エラーの場合、query_gemini関数は呼ばれないので、
     # 明示的なチェックは不要（早期リターンでquery_geminiは実行されない）
+
+
+def test_single_endpoint_rate_limit(monkeypatch):
+    """
+    single 関数のテスト（レート制限）
+    """
+
+    def mock_query_gemini(*args, **kwargs):
+        raise RateLimitError("gemini-2.0-flash", retry_after=1.2)
+
+    monkeypatch.setattr("main.query_gemini", mock_query_gemini)
+    response = client.post("/single", json={"key": AUTH_KEY, "q": "テスト質問"})
+
+    # 500 ではなく 429 と Retry-After ヘッダーを返す
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+
+
+def test_multi_grid_size_limit(monkeypatch):
+    """
+    multi 関数のテスト（グリッドの上限超過）
+    """
+    monkeypatch.setattr("models.MAX_GRID_CELLS", 4)
+    response = client.post(
+        "/multi",
+        json={
+            "key": AUTH_KEY,
+            "q": "テスト質問",
+            "options": {
+                "models": ["gemini-2.0-flash", "gemini-1.5-flash"],
+                "roles": ["役割1", "役割2", "役割3"],
+            },
+        },
+    )
+
+    # バリデーションエラーを確認
+    assert response.status_code == 422
+
+
+def test_multi_pagination(monkeypatch):
+    """
+    multi 関数のテスト（カーソルによるページング）
+    """
+
+    def mock_grid_query_gemini(
+        q, roles, model_names, temperature, max_tokens, start, stop, timings
+    ):
+        cells = [(m, r) for m in model_names for r in roles][start:stop]
+        return [
+            (
+                f"{model_name.value}:{role}",
+                QueryArgs(
+                    query=q,
+                    role=role,
+                    model_name=model_name,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                ),
+            )
+            for model_name, role in cells
+        ]
+
+    monkeypatch.setattr("main.grid_query_gemini", mock_grid_query_gemini)
+
+    request = {
+        "key": AUTH_KEY,
+        "q": "テスト質問",
+        "options": {
+            "models": ["gemini-2.0-flash", "gemini-1.5-flash"],
+            "roles": ["役割1", "役割2", "役割3"],
+            "page_size": 4,
+        },
+    }
+
+    # 1ページ目
+    response = client.post("/multi", json=request)
+    assert response.status_code == 200
+    data = response.json()
+    assert [item["id"] for item in data["data"]] == [1, 2, 3, 4]
+    assert data["meta"]["total"] == 6
+    assert data["meta"]["next_cursor"] is not None
+
+    # 2ページ目
+    response = client.post(
+        "/multi", json={**request, "cursor": data["meta"]["next_cursor"]}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert [item["id"] for item in data["data"]] == [5, 6]
+    assert data["data"][0]["result"] == "gemini-1.5-flash:役割2"
+    assert data["meta"]["next_cursor"] is None
+
+
+def test_multi_invalid_cursor():
+    """
+    multi 関数のテスト（不正なカーソル）
+    """
+    response = client.post(
+        "/multi",
+        json={"key": AUTH_KEY, "q": "テスト質問", "cursor": "invalid"},
+    )
+
+    assert response.status_code == 400
+    assert response.json()["detail"] == "カーソルが無効です"
+
+
+def test_single_endpoint_timing(monkeypatch):
+    """
+    single 関数のテスト（処理時間の内訳）
+    """
+
+    def mock_query_gemini(*args, timings=None, **kwargs):
+        if timings is not None:
+            timings["client"] = 0.1
+            timings["upstream"] = 0.2
+        return "これはテスト回答です。", QueryArgs(
+            query="テスト質問",
+            role="あなたは親切なアシスタントです。",
+            model_name="gemini-2.0-flash",
+            temperature=0.7,
+            max_tokens=1024,
+        )
+
+    monkeypatch.setattr("main.query_gemini", mock_query_gemini)
+
+    response = client.post(
+        "/single?timing=true", json={"key": AUTH_KEY, "q": "テスト質問"}
+    )
+
+    assert response.status_code == 200
+    assert response.headers["Server-Timing"].startswith("serialize;dur=")
+    timing = response.json()["meta"]["timing"]
+    assert set(timing) == {
+        "validation",
+        "queue",
+        "auth",
+        "query",
+        "response",
+        "client",
+        "upstream",
+    }
+    assert timing["upstream"] == 0.2
+
+
+def test_single_endpoint_profile(monkeypatch, tmp_path):
+    """
+    single 関数のテスト（プロセス全体のプロファイルの取得とダウンロード）
+    """
+    import pstats
+
+    def mock_query_gemini(*args, **kwargs):
+        return "これはテスト回答です。", QueryArgs(
+            query="テスト質問",
+            role="あなたは親切なアシスタントです。",
+            model_name="gemini-2.0-flash",
+            temperature=0.7,
+            max_tokens=1024,
+        )
+
+    monkeypatch.setattr("main.query_gemini", mock_query_gemini)
+    request = {"key": AUTH_KEY, "q": "テスト質問"}
+
+    # 管理者キーがない場合はエラー
+    response = client.post("/single?profile=true", json=request)
+    assert response.status_code == 403
+
+    response = client.post(
+        "/single?profile=true", json=request, headers={"X-Admin-Key": ADMIN_KEY}
+    )
+    assert response.status_code == 200
+    profile_id = response.json()["meta"]["profile_id"]
+
+    # ダウンロードしたファイルを pstats で読み込めることを確認
+    response = client.get(
+        f"/admin/profiles/{profile_id}", headers={"X-Admin-Key": ADMIN_KEY}
+    )
+    assert response.status_code == 200
+    path = tmp_path / "profile.prof"
+    path.write_bytes(response.content)
+    stats = pstats.Stats(str(path))
+    assert any(func[2] == "mock_query_gemini" for func in stats.stats)  # type: ignore[attr-defined]
+
+
+def test_websocket_invalid_auth():
+    """
+    websocket_session 関数のテスト（認証エラー）
+    """
+    with client.websocket_connect("/ws") as websocket:
+        websocket.send_json({"key": "invalid_key"})
+        with pytest.raises(WebSocketDisconnect) as exc_info:
+            websocket.receive_json()
+    assert exc_info.value.code == 1008
+
+    # 最初のメッセージがバイナリの場合も認証エラーで閉じる
+    with client.websocket_connect("/ws") as websocket:
+        websocket.send_bytes(b"binary")
+        with pytest.raises(WebSocketDisconnect) as exc_info:
+            websocket.receive_json()
+    assert exc_info.value.code == 1008
+
+
+def test_websocket_session(monkeypatch):
+    """
+    websocket_session 関数のテスト（複数の問い合わせ）
+    """
+
+    async def mock_aquery_gemini(q, role, model_name, temperature, max_tokens):
+        return f"{q}:{role}", QueryArgs(
+            query=q,
+            role=role,
+            model_name=model_name,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+
+    monkeypatch.setattr("main.aquery_gemini", mock_aquery_gemini)
+
+    with client.websocket_connect("/ws") as websocket:
+        websocket.send_json({"key": AUTH_KEY})
+        # ID は文字列でも数値でもよい
+        websocket.send_json({"type": "single", "id": 7, "q": "質問1"})
+        websocket.send_json(
+            {
+                "type": "multi",
+                "id": "m1",
+                "q": "質問2",
+                "options": {"roles": ["役割1", "役割2"]},
+            }
+        )
+        websocket.send_json({"type": "unknown", "id": "x"})
+
+        messages = [websocket.receive_json() for _ in range(5)]
+
+    by_id = {}
+    for message in messages:
+        by_id.setdefault(message["id"], []).append(message)
+
+    assert by_id[7][0]["data"]["result"] == "質問1:あなたは親切なアシスタントです。"
+    assert by_id[7][0]["done"] is True
+    items = [m["item"] for m in by_id["m1"] if "item" in m]
+    assert sorted(item["id"] for item in items) == [1, 2]
+    assert by_id["m1"][-1]["done"] is True
+    assert by_id["m1"][-1]["meta"]["total"] == 2
+    assert "error" in by_id["x"][0]
+
+
+def test_usage_summary(monkeypatch):
+    """
+    usage_summary 関数のテスト
+    """
+
+    def mock_query_gemini(*args, **kwargs):
+        return "これはテスト回答です。", QueryArgs(
+            query="テスト質問",
+            role="あなたは親切なアシスタントです。",
+            model_name="gemini-2.0-flash",
+            temperature=0.7,
+            max_tokens=1024,
+            usage={"input_tokens": 10, "output_tokens": 20, "total_tokens": 30},
+        )
+
+    monkeypatch.setattr("main.query_gemini", mock_query_gemini)
+    monkeypatch.setattr("main.USAGE", UsageLedger())
+
+    response = client.post("/single", json={"key": AUTH_KEY, "q": "テスト質問"})
+    assert response.status_code == 200
+    assert response.json()["meta"]["usage"]["total_tokens"] == 30
+
+    # 管理者キーがない場合はエラー
+    response = client.get("/admin/usage")
+    assert response.status_code == 403
+
+    response = client.get("/admin/usage", headers={"X-Admin-Key": ADMIN_KEY})
+    assert response.status_code == 200
+    (summary,) = response.json()
+    assert summary["caller"] == caller_id(AUTH_KEY)
+    assert summary["model"] == "gemini-2.0-flash"
+    assert summary["output_tokens"] == 20
+
+
+def test_multi_cursor_other_grid(monkeypatch):
+    """
+    multi 関数のテスト（別のグリッドで発行されたカーソル）
+    """
+    monkeypatch.setattr("main.grid_query_gemini", lambda **kwargs: [])
+    request = {
+        "key": AUTH_KEY,
+        "q": "テスト質問",
+        "options": {"roles": ["役割1", "役割2", "役割3"], "page_size": 1},
+    }
+    response = client.post("/multi", json=request)
+    cursor = response.json()["meta"]["next_cursor"]
+
+    # 役割が異なるグリッドでは同じカーソルを使えない
+    request["options"]["roles"] = ["役割A", "役割B", "役割C"]
+    response = client.post("/multi", json={**request, "cursor": cursor})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "カーソルが無効です"
+
+
+def test_websocket_errors(monkeypatch):
+    """
+    websocket_session 関数のテスト（問い合わせのエラーと不正なメッセージ）
+    """
+
+    async def mock_aquery_gemini(**kwargs):
+        raise RuntimeError("Gemini APIのエラー")
+
+    monkeypatch.setattr("main.aquery_gemini", mock_aquery_gemini)
+
+    with client.websocket_connect("/ws") as websocket:
+        websocket.send_json({"key": AUTH_KEY})
+        websocket.send_json({"type": "single", "id": "s1", "q": "質問1"})
+        assert websocket.receive_json() == {"id": "s1", "error": "Gemini APIのエラー"}
+        websocket.send_json({"type": "multi", "id": "m1", "q": "質問2"})
+        assert websocket.receive_json() == {"id": "m1", "error": "Gemini APIのエラー"}
+
+        # 検証エラーでも id を返す
+        websocket.send_json({"type": "single", "id": "s2"})
+        message = websocket.receive_json()
+        assert message["id"] == "s2"
+        assert "error" in message
+
+        # バイナリのメッセージでもセッションは続く
+        websocket.send_bytes(b"binary")
+        assert websocket.receive_json()["id"] is None
+        websocket.send_json({"type": "single", "id": "s3", "q": "質問3"})
+        assert websocket.receive_json()["id"] == "s3"
+
+
+@pytest.mark.asyncio
+async def test_websocket_send_failure(monkeypatch):
+    """
+    websocket_session 関数のテスト（送信に失敗した場合にセッションが終了する）
+    """
+
+    async def mock_aquery_gemini(q, role, model_name, temperature, max_tokens):
+        return "回答", QueryArgs(
+            query=q,
+            role=role,
+            model_name=model_name,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+
+    class BrokenWebSocket:
+        """送信に失敗し、問い合わせのメッセージを受信し続ける WebSocket"""
+
+        async def accept(self):
+            pass
+
+        async def receive_json(self):
+            return {"key": AUTH_KEY}
+
+        async def receive_text(self):
+            return json.dumps({"type": "single", "id": "s", "q": "質問"})
+
+        async def send_json(self, message):
+            raise RuntimeError("切断されました")
+
+    monkeypatch.setattr("main.aquery_gemini", mock_aquery_gemini)
+    monkeypatch.setattr("main.WS_MAX_IN_FLIGHT", 1)
+    monkeypatch.setattr("main.WS_SEND_QUEUE_SIZE", 1)
+
+    await asyncio.wait_for(websocket_session(BrokenWebSocket()), timeout=2)
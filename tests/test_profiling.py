@@ -0,0 +1,65 @@
+"""
+profiling モジュールのテスト
+"""
+
+import marshal
+import time
+
+import pytest
+
+import profiling
+from profiling import PROFILES, PhaseTimer, ProcessProfile, load_profile
+from sharedstate import SharedState
+
+
+def test_phase_timer():
+    """PhaseTimer クラスのテスト"""
+    timer = PhaseTimer()
+    timer.lap("first")
+    timer.lap("second")
+    assert list(timer.phases) == ["first", "second"]
+    assert all(duration >= 0 for duration in timer.phases.values())
+
+
+def test_phase_timer_at():
+    """PhaseTimer クラスのテスト（時刻を指定した記録）"""
+    timer = PhaseTimer(started_at=10.0)
+    timer.lap("first", at=10.5)
+    timer.lap("second", at=12.0)
+    assert timer.phases == {"first": 0.5, "second": 1.5}
+
+
+def test_process_profile_lock():
+    """取得中は別のプロファイルを開始できないことのテスト"""
+    with ProcessProfile() as profile_id:
+        with pytest.raises(RuntimeError):
+            ProcessProfile()
+    assert profile_id in PROFILES
+
+    # 終了後は再び取得できる
+    with ProcessProfile():
+        pass
+
+
+def test_process_profile_timeout(monkeypatch):
+    """最大秒数を超えると自動で停止してロックを解放することのテスト"""
+    monkeypatch.setattr(profiling, "MAX_PROFILE_SECONDS", 0.05)
+    profile = ProcessProfile()
+    with profile as profile_id:
+        time.sleep(0.2)
+        assert profile_id in PROFILES
+        # 自動停止後は別のプロファイルを開始できる
+        with ProcessProfile():
+            pass
+    assert profile.stopped_at - profile.started_at < 0.2
+
+
+def test_process_profile_shared_state(tmp_path):
+    """SharedState を指定した場合に別インスタンスからプロファイルを取得できるテスト"""
+    path = str(tmp_path / "state.db")
+    with ProcessProfile(SharedState(path)) as profile_id:
+        pass
+    assert profile_id not in PROFILES
+    data = load_profile(profile_id, SharedState(path))
+    assert isinstance(marshal.loads(data), dict)
+    assert load_profile("unknown", SharedState(path)) is None
@@ -3,6 +3,9 @@ searchapi モジュールのテスト
 """
 
 import os
+import subprocess
+import sys
+from pathlib import Path
 from unittest import mock
 
 import pytest
@@ -10,9 +13,11 @@ import pytest
 from searchapi import (
     agrid_query_gemini,
     aquery_gemini,
+    grid_cells,
     grid_query_gemini,
     query_gemini,
 )
+from sharedstate import SharedState
 
 
 class MockChatGoogleGenerativeAI:
@@ -79,6 +84,28 @@ def test_query_gemini(mock_env, mock_chat_gemini):
     assert args["max_tokens"] == 100
 
 
+def test_query_gemini_usage(mock_env):
+    """query_gemini 関数のテスト（トークン使用量の記録）"""
+    response = mock.MagicMock(
+        content="モックされた応答",
+        usage_metadata={"input_tokens": 10, "output_tokens": 20, "total_tokens": 30},
+    )
+    with mock.patch("searchapi.ChatGoogleGenerativeAI") as chat:
+        chat.return_value.invoke.return_value = response
+        _, args = query_gemini(
+            q="テストクエリ",
+            role="テストロール",
+            model_name="gemini-2.0-flash",
+            temperature=0.7,
+        )
+
+    assert args["usage"] == {
+        "input_tokens": 10,
+        "output_tokens": 20,
+        "total_tokens": 30,
+    }
+
+
 def test_grid_query_gemini(mock_env, mock_chat_gemini):
     """grid_query_deepseek 関数のテスト"""
     roles = ("テストロール1", "テストロール2")
@@ -151,6 +178,93 @@ async def test_agrid_query_gemini(mock_env, mock_chat_gemini):
         assert args["max_tokens"] == 100
 
 
+def test_grid_cells():
+    """grid_cells 関数のテスト"""
+    roles = ("テストロール1", "テストロール2")
+    model_names = ("gemini-2.0-flash", "gemini-2.5-flash")
+
+    assert list(grid_cells(roles, model_names)) == [
+        ("gemini-2.0-flash", "テストロール1"),
+        ("gemini-2.0-flash", "テストロール2"),
+        ("gemini-2.5-flash", "テストロール1"),
+        ("gemini-2.5-flash", "テストロール2"),
+    ]
+    assert list(grid_cells(roles, model_names, 1, 3)) == [
+        ("gemini-2.0-flash", "テストロール2"),
+        ("gemini-2.5-flash", "テストロール1"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_agrid_query_gemini_invalid_chunk_size(mock_env, mock_chat_gemini):
+    """agrid_query_gemini 関数のテスト（chunk_size が0以下）"""
+    with pytest.raises(ValueError):
+        await agrid_query_gemini(
+            q="テストクエリ",
+            roles=("テストロール",),
+            model_names=("gemini-2.0-flash",),
+            temperature=0.7,
+            chunk_size=0,
+        )
+
+
+def test_grid_chunk_size_env():
+    """環境変数 GRID_CHUNK_SIZE が0以下の場合に起動時にエラーになるテスト"""
+    result = subprocess.run(
+        [sys.executable, "-c", "import searchapi"],
+        env={**os.environ, "GOOGLE_API_KEY": "x", "GRID_CHUNK_SIZE": "0"},
+        cwd=Path(__file__).parent.parent,
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode != 0
+    assert "GRID_CHUNK_SIZE" in result.stderr
+
+
+@pytest.mark.asyncio
+async def test_agrid_query_gemini_chunked(mock_env, mock_chat_gemini):
+    """agrid_query_gemini 関数のテスト（分割実行と範囲指定）"""
+    roles = ("テストロール1", "テストロール2", "テストロール3")
+    model_names = ("gemini-2.0-flash", "gemini-2.5-flash")
+    results = await agrid_query_gemini(
+        q="テストクエリ",
+        roles=roles,
+        model_names=model_names,
+        temperature=0.7,
+        max_tokens=100,
+        start=1,
+        stop=6,
+        chunk_size=2,
+    )
+
+    # 範囲内の組み合わせが順番どおりに返ることを検証
+    assert [(args["model_name"], args["role"]) for _, args in results] == list(
+        grid_cells(roles, model_names, 1, 6)
+    )
+
+
+def test_query_gemini_shared_state(mock_env, mock_chat_gemini, tmp_path):
+    """SHARED_STATE を設定した場合に回答がキャッシュされることのテスト"""
+    state = SharedState(str(tmp_path / "state.db"))
+    with mock.patch("searchapi.SHARED_STATE", state):
+        result, _ = query_gemini(
+            q="テストクエリ",
+            role="テストロール",
+            model_name="gemini-2.0-flash",
+            temperature=0.7,
+        )
+        with mock.patch("searchapi.ChatGoogleGenerativeAI") as chat:
+            cached, _ = query_gemini(
+                q="テストクエリ",
+                role="テストロール",
+                model_name="gemini-2.0-flash",
+                temperature=0.7,
+            )
+
+    assert result == cached == "モックされた応答"
+    chat.assert_not_called()
+
+
 def test_no_api_key():
     """API キーが設定されていない場合のエラーテスト"""
     with mock.patch.dict(os.environ, {}, clear=True):
@@ -0,0 +1,112 @@
+"""
+sharedstate モジュールのテスト
+"""
+
+import threading
+import time
+
+import pytest
+
+from sharedstate import RateLimitError, SharedState, make_key
+
+
+@pytest.fixture
+def state(tmp_path):
+    """一時ファイルを使う SharedState"""
+    return SharedState(str(tmp_path / "state.db"), poll_interval=0.01)
+
+
+def test_make_key():
+    """make_key 関数のテスト"""
+    assert make_key(q="a", role="b") == make_key(role="b", q="a")
+    assert make_key(q="a", role="b") != make_key(q="a", role="c")
+
+
+def test_cache(state):
+    """キャッシュの保存と期限切れのテスト"""
+    assert state.cache_get("key") is None
+    state.cache_set("key", "値")
+    assert state.cache_get("key") == "値"
+
+    state.cache_ttl = -1
+    state.cache_set("key", "値")
+    assert state.cache_get("key") is None
+
+
+def test_rate_limit(tmp_path):
+    """レート制限のテスト（別インスタンス間で残り回数を共有する）"""
+    path = str(tmp_path / "state.db")
+    state1 = SharedState(path, rate_per_minute=2, rate_timeout=0.1)
+    state2 = SharedState(path, rate_per_minute=2, rate_timeout=0.1)
+
+    assert state1.try_acquire_token("model") == 0
+    assert state2.try_acquire_token("model") == 0
+    assert state1.try_acquire_token("model") > 0
+    with pytest.raises(RateLimitError) as e:
+        state2.wait_for_token("model")
+    assert e.value.retry_after > 0
+    # キーが異なれば別の残り回数
+    assert state2.try_acquire_token("other") == 0
+
+
+def test_get_or_compute_coalesce(state):
+    """同時に来た同じキーの問い合わせが1回だけ実行されることのテスト"""
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.1)
+        return "回答"
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(state.get_or_compute("key", compute, "m"))
+        )
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["回答"] * 5
+    assert len(calls) == 1
+
+
+def test_get_or_compute_error(state):
+    """compute が失敗した場合は実行権を手放し、次の呼び出しで再実行されるテスト"""
+
+    def fail():
+        raise ValueError("失敗")
+
+    with pytest.raises(ValueError):
+        state.get_or_compute("key", fail, "m")
+    assert state.get_or_compute("key", lambda: "回答", "m") == "回答"
+
+
+def test_rate_limit_fail_fast(tmp_path):
+    """デフォルトではレート制限で待たずにエラーになることのテスト"""
+    state = SharedState(str(tmp_path / "state.db"), rate_per_minute=1)
+    state.wait_for_token("model")
+
+    started_at = time.monotonic()
+    with pytest.raises(RateLimitError) as e:
+        state.wait_for_token("model")
+    assert time.monotonic() - started_at < 1
+    assert 0 < e.value.retry_after <= 60
+
+
+def test_get_or_compute_coalesce_timeout(tmp_path):
+    """実行中の問い合わせを coalesce_timeout 秒だけ待って自分で実行するテスト"""
+    path = str(tmp_path / "state.db")
+    holder = SharedState(path)
+    state = SharedState(path, coalesce_timeout=0.1)
+    # 他のプロセスが実行権を持ったまま終わらない場合
+    assert holder._claim("key")
+
+    started_at = time.monotonic()
+    assert state.get_or_compute("key", lambda: "回答", "m") == "回答"
+    assert time.monotonic() - started_at < 1
+    # 自分の実行権ではないので、他のプロセスの実行権は残る
+    assert not state._claim("key")
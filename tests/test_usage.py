@@ -0,0 +1,88 @@
+"""
+usage モジュールのテスト
+"""
+
+from models import QueryArgs
+from sharedstate import SharedState
+from usage import UsageLedger, caller_id, total_usage, usage_cost
+
+
+def make_args(model_name, output_tokens=None, max_tokens=1024):
+    """テスト用の QueryArgs を作る（output_tokens が None の場合は usage なし）"""
+    args = QueryArgs(
+        query="テスト質問",
+        role="テストロール",
+        model_name=model_name,
+        temperature=0.7,
+        max_tokens=max_tokens,
+    )
+    if output_tokens is not None:
+        args["usage"] = {
+            "input_tokens": 100,
+            "output_tokens": output_tokens,
+            "total_tokens": 100 + output_tokens,
+        }
+    return args
+
+
+def test_usage_cost():
+    """usage_cost 関数のテスト"""
+    assert usage_cost("gemini-2.0-flash", 1_000_000, 1_000_000) == 0.5
+    assert usage_cost("unknown", 1_000_000, 1_000_000) == 0
+
+
+def test_total_usage():
+    """total_usage 関数のテスト"""
+    totals = total_usage(
+        [make_args("gemini-2.0-flash", 50), make_args("gemini-2.0-flash")]
+    )
+    assert totals["input_tokens"] == 100
+    assert totals["output_tokens"] == 50
+    assert totals["total_tokens"] == 150
+    assert totals["cost_usd"] > 0
+
+
+def test_usage_ledger():
+    """UsageLedger クラスのテスト"""
+    ledger = UsageLedger()
+    caller = caller_id("key1")
+    ledger.record(
+        caller,
+        [
+            make_args("gemini-2.0-flash", 50),
+            make_args("gemini-2.0-flash", 200, max_tokens=200),
+            make_args("gemini-2.0-flash"),
+            make_args("gemini-1.5-flash", 10),
+        ],
+    )
+    ledger.record(caller_id("key2"), [make_args("gemini-2.0-flash", 30)])
+
+    (summary,) = ledger.summary(caller=caller, model="gemini-2.0-flash")
+    assert summary.requests == 3
+    assert summary.cached == 1
+    assert summary.output_tokens == 250
+    assert summary.max_output_tokens == 200
+    assert summary.max_tokens_hits == 1
+    assert len(ledger.summary(caller=caller)) == 2
+    assert len(ledger.summary(model="gemini-2.0-flash")) == 2
+
+
+def test_usage_ledger_shared_state(tmp_path):
+    """SharedState を指定した場合に別インスタンス間で集計を共有するテスト"""
+    path = str(tmp_path / "state.db")
+    ledger1 = UsageLedger(SharedState(path))
+    ledger2 = UsageLedger(SharedState(path))
+    caller = caller_id("key1")
+    ledger1.record(
+        caller, [make_args("gemini-2.0-flash", 50), make_args("gemini-2.0-flash")]
+    )
+    ledger2.record(caller, [make_args("gemini-2.0-flash", 200, max_tokens=200)])
+
+    (summary,) = ledger2.summary(caller=caller, model="gemini-2.0-flash")
+    assert summary.requests == 3
+    assert summary.cached == 1
+    assert summary.output_tokens == 250
+    assert summary.max_output_tokens == 200
+    assert summary.max_tokens_hits == 1
+    assert summary.cost_usd > 0
+    assert ledger1.summary(caller=caller_id("key2")) == []
@@ -0,0 +1,138 @@
+"""
+トークン使用量と費用を集計するモジュール
+
+問い合わせごとの QueryArgs["usage"] を、呼び出し元（認証キー）とモデルごとに集計する。
+SharedState を指定した場合は SQLite ファイルに集計するので、複数ワーカーの合計になる
+（指定しない場合はプロセス内で集計するため、ワーカーごとの値になる）。
+"""
+
+import hashlib
+import threading
+from collections.abc import Iterable
+
+from models import QueryArgs, UsageSummary
+from sharedstate import SharedState
+
+# モデルごとの 100 万トークンあたりの価格（米ドル、入力・出力）
+# 2025年6月時点の公開価格を元にした概算値
+MODEL_PRICES: dict[str, tuple[float, float]] = {
+    "gemini-2.0-flash": (0.10, 0.40),
+    "gemini-1.5-flash": (0.075, 0.30),
+    "gemini-2.5-flash-preview-05-20": (0.15, 0.60),
+}
+
+
+def caller_id(key: str) -> str:
+    """認証キーから呼び出し元のIDを作る（キーそのものは保存しない）"""
+    return hashlib.sha256(key.encode()).hexdigest()[:12]
+
+
+def model_id(args: QueryArgs) -> str:
+    """QueryArgs のモデル名を文字列で返す"""
+    model_name = args["model_name"]
+    return str(getattr(model_name, "value", model_name))
+
+
+def usage_cost(model: str, input_tokens: int, output_tokens: int) -> float:
+    """トークン数から概算費用（米ドル）を求める（価格が不明なモデルは 0）"""
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+
+def total_usage(args_list: Iterable[QueryArgs]) -> dict[str, int | float]:
+    """複数の問い合わせのトークン使用量と概算費用を合計する（meta 用）"""
+    totals: dict[str, int | float] = {
+        "input_tokens": 0,
+        "output_tokens": 0,
+        "total_tokens": 0,
+        "cost_usd": 0.0,
+    }
+    for args in args_list:
+        usage = args.get("usage")
+        if usage is None:
+            continue
+        totals["input_tokens"] += usage["input_tokens"]
+        totals["output_tokens"] += usage["output_tokens"]
+        totals["total_tokens"] += usage["total_tokens"]
+        totals["cost_usd"] += usage_cost(
+            model_id(args), usage["input_tokens"], usage["output_tokens"]
+        )
+    return totals
+
+
+class UsageLedger:
+    """呼び出し元・モデルごとのトークン使用量を集計するクラス"""
+
+    def __init__(self, state: SharedState | None = None) -> None:
+        """
+        Args:
+            state: 集計を共有する SharedState（省略時はプロセス内で集計する）
+        """
+        self.state = state
+        self._lock = threading.Lock()
+        self._summaries: dict[tuple[str, str], UsageSummary] = {}
+
+    def record(self, caller: str, args_list: Iterable[QueryArgs]) -> None:
+        """問い合わせのトークン使用量を集計に加える
+
+        Args:
+            caller: 呼び出し元のID（caller_id の戻り値）
+            args_list: 問い合わせごとの QueryArgs
+        """
+        deltas: dict[str, UsageSummary] = {}
+        for args in args_list:
+            model = model_id(args)
+            summary = deltas.setdefault(model, UsageSummary(caller=caller, model=model))
+            summary.requests += 1
+
+            usage = args.get("usage")
+            if usage is None:
+                summary.cached += 1
+                continue
+            summary.input_tokens += usage["input_tokens"]
+            summary.output_tokens += usage["output_tokens"]
+            summary.total_tokens += usage["total_tokens"]
+            summary.max_output_tokens = max(
+                summary.max_output_tokens, usage["output_tokens"]
+            )
+            max_tokens = args["max_tokens"]
+            if max_tokens is not None and usage["output_tokens"] >= max_tokens:
+                summary.max_tokens_hits += 1
+            summary.cost_usd += usage_cost(
+                model, usage["input_tokens"], usage["output_tokens"]
+            )
+
+        if self.state is not None:
+            for model, delta in deltas.items():
+                self.state.add_usage(caller, model, delta.model_dump())
+            return
+        with self._lock:
+            for model, delta in deltas.items():
+                summary = self._summaries.get((caller, model))
+                if summary is None:
+                    self._summaries[(caller, model)] = delta
+                    continue
+                summary.requests += delta.requests
+                summary.cached += delta.cached
+                summary.input_tokens += delta.input_tokens
+                summary.output_tokens += delta.output_tokens
+                summary.total_tokens += delta.total_tokens
+                summary.max_output_tokens = max(
+                    summary.max_output_tokens, delta.max_output_tokens
+                )
+                summary.max_tokens_hits += delta.max_tokens_hits
+                summary.cost_usd += delta.cost_usd
+
+    def summary(
+        self, caller: str | None = None, model: str | None = None
+    ) -> list[UsageSummary]:
+        """集計結果を返す（caller や model を指定した場合は絞り込む）"""
+        if self.state is not None:
+            return [UsageSummary(**row) for row in self.state.usage_rows(caller, model)]
+        with self._lock:
+            return [
+                summary.model_copy()
+                for (summary_caller, summary_model), summary in self._summaries.items()
+                if (caller is None or summary_caller == caller)
+                and (model is None or summary_model == model)
+            ]